@@ -0,0 +1,265 @@
+try:
+    import numpy
+except ImportError: # only needed for this module, so report it on use
+    numpy = None
+import json
+import os
+from coursedb import QuestionStats, iter_chunks
+
+NULL = -1 # how SQL NULLs are stored in the integer arrays below
+
+# (table, sql, rowid expression, question_id expression, dtype fields).
+# reasons are stored as an index into QuestionStats.statuses, or NULL
+_tables = (
+    ('responses',
+     '''select id, question_id, uid, coalesce(cluster_id, -1),
+     coalesce(cast(confidence as integer), -1),
+     case reasons when 'different' then 0 when 'close' then 1
+     when 'correct' then 2 else -1 end,
+     coalesce(switched_id, -1), coalesce(final_id, -1),
+     coalesce(cast(final_conf as integer), -1)
+     from responses where 1''', 'id', 'question_id',
+     [('rowid', 'i8'), ('question_id', 'i8'), ('uid', 'i8'),
+      ('cluster_id', 'i8'), ('confidence', 'i1'), ('reasons', 'i1'),
+      ('switched_id', 'i8'), ('final_id', 'i8'), ('final_conf', 'i1')]),
+    ('student_errors',
+     '''select t1.rowid, t2.question_id, t1.error_id, t1.uid
+     from student_errors t1, error_models t2 where t1.error_id=t2.id''',
+     't1.rowid', 't2.question_id',
+     [('rowid', 'i8'), ('question_id', 'i8'), ('error_id', 'i8'),
+      ('uid', 'i8')]),
+    ('error_models',
+     'select id, question_id from error_models where 1', 'id', 'question_id',
+     [('rowid', 'i8'), ('question_id', 'i8')]),
+)
+
+_cacheFormat = 2 # increment whenever _tables (or the cache logic) changes
+
+def group_counts(*columns):
+    '''count each distinct combination of values in equal-length integer
+    columns, returning (keys, counts), where keys is a structured array
+    with fields f0, f1, ... in sorted order'''
+    keys = numpy.empty(len(columns[0]),
+                       dtype=[('f%d' % i, 'i8') for i in range(len(columns))])
+    for i, column in enumerate(columns):
+        keys['f%d' % i] = column
+    return numpy.unique(keys, return_counts=True)
+
+def fetch_array(c, sql, args, dtype, chunkSize=10000):
+    'run query, returning its rows as a structured array'
+    c.execute(sql, args)
+    l = []
+    while True:
+        rows = c.fetchmany(chunkSize)
+        if not rows:
+            break
+        l.append(numpy.array(rows, dtype=dtype))
+    if not l:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.concatenate(l)
+
+class Analytics(object):
+    '''rows of responses, student_errors and error_models as NumPy
+    structured arrays, with vectorized group-bys over them.  The arrays
+    are memory-mapped from .npy cache files next to the database;
+    refresh() only re-reads rows added since (by rowid), and the rows of
+    questions whose question_changes serial has moved.
+    Can be used as the statistics backend of CourseReport by setting
+    its analytics attribute.'''
+    def __init__(self, dbfile='course.db', cachePrefix=None):
+        if numpy is None:
+            raise ImportError('socraticqs.analytics requires numpy')
+        if cachePrefix is None:
+            cachePrefix = dbfile
+        self.cachePrefix = cachePrefix
+        self.arrays = {}
+        self.maxRowids = {}
+        self.serials = {} # question_changes serials when last refreshed
+        self.load_cache()
+
+    def cache_path(self, name):
+        return '%s.%s.npy' % (self.cachePrefix, name)
+
+    def load_cache(self):
+        'memory-map cached arrays, if the cache is complete and current'
+        try:
+            ifile = open(self.cachePrefix + '.analytics.json', 'rb')
+        except IOError:
+            return
+        try:
+            meta = json.load(ifile)
+        finally:
+            ifile.close()
+        if meta.get('format') != _cacheFormat:
+            return
+        try:
+            arrays = dict([(t[0], self._load(self.cache_path(t[0])))
+                           for t in _tables])
+        except IOError:
+            return
+        self.arrays = arrays
+        self.maxRowids = meta['maxRowids']
+        self.serials = dict([(int(qid), serial) for qid, serial
+                             in meta['serials'].items()])
+
+    def _load(self, path):
+        try:
+            return numpy.load(path, mmap_mode='r')
+        except ValueError: # cannot mmap an empty array
+            return numpy.load(path)
+
+    def _save(self, name, a):
+        'write array to its cache file, and return it memory-mapped'
+        path = self.cache_path(name)
+        ofile = open(path + '.tmp', 'wb')
+        try:
+            numpy.save(ofile, a)
+        finally:
+            ofile.close()
+        os.rename(path + '.tmp', path) # readers never see a partial file
+        return self._load(path)
+
+    def refresh(self, c):
+        'bring arrays up to date with the database, using cursor c'
+        c.execute('select question_id, serial from question_changes')
+        serials = dict(c.fetchall()) # read before rows, never after
+        changed = [qid for qid, serial in serials.items()
+                   if self.serials.get(qid) != serial]
+        for name, sql, rowidExpr, qidExpr, dtype in _tables:
+            c.execute('select coalesce(max(rowid), 0) from %s' % name)
+            maxRowid = self.maxRowids.get(name, 0)
+            orderBy = ' order by ' + rowidExpr # joins may return index order
+            if name not in self.arrays or c.fetchone()[0] < maxRowid:
+                a = fetch_array(c, sql + orderBy, (), dtype) # (re)load all
+            else:
+                l = [fetch_array(c, sql + ' and %s>?' % rowidExpr + orderBy,
+                                 (maxRowid,), dtype)]
+                for chunk in iter_chunks(changed, 500):
+                    l.append(fetch_array(c, sql + ' and %s<=? and %s in (%s)'
+                                         % (rowidExpr, qidExpr,
+                                            ','.join('?' * len(chunk)))
+                                         + orderBy, [maxRowid] + chunk, dtype))
+                if not sum([len(x) for x in l]) and not changed:
+                    continue # nothing new
+                old = self.arrays[name]
+                if changed:
+                    old = old[~numpy.in1d(old['question_id'], changed)]
+                a = numpy.concatenate([old] + l)
+                a = a[numpy.argsort(a['rowid'], kind='mergesort')]
+            self.arrays[name] = self._save(name, a)
+            if len(a):
+                self.maxRowids[name] = int(a['rowid'].max())
+            else:
+                self.maxRowids[name] = 0
+        self.serials = serials
+        ofile = open(self.cachePrefix + '.analytics.json.tmp', 'wb')
+        try:
+            json.dump(dict(format=_cacheFormat, maxRowids=self.maxRowids,
+                           serials=serials), ofile)
+        finally:
+            ofile.close()
+        os.rename(self.cachePrefix + '.analytics.json.tmp',
+                  self.cachePrefix + '.analytics.json')
+
+    def rows(self, name, qlist=None):
+        'array of rows of table name, for questions in qlist (default: all)'
+        a = self.arrays[name]
+        if qlist is not None:
+            a = a[numpy.in1d(a['question_id'], list(qlist))]
+        return a
+
+    def question_stats(self, qlist=None):
+        '''compute QuestionStats for questions in qlist (default: all),
+        returning dict of {questionID:stats} like
+        CourseReport.get_question_stats().  Reasons other than the
+        QuestionStats.statuses are all counted as None.'''
+        d = {}
+        if qlist:
+            for qid in qlist:
+                d[qid] = QuestionStats(qid)
+        def get(qid):
+            try:
+                return d[qid]
+            except KeyError:
+                stats = d[qid] = QuestionStats(qid)
+                return stats
+        r = self.rows('responses', qlist)
+        keys, counts = group_counts(r['question_id'], r['reasons'],
+                                    r['confidence'])
+        statuses = [unicode(s) for s in QuestionStats.statuses] # as sqlite
+        for (qid, reasons, confidence), k in zip(keys.tolist(),
+                                                 counts.tolist()):
+            if reasons == NULL:
+                reasons = None
+            else:
+                reasons = statuses[reasons]
+            if confidence == NULL:
+                confidence = None
+            get(qid).add_responses(reasons, confidence, k)
+        se = self.rows('student_errors', qlist)
+        keys, counts = group_counts(se['question_id'], se['error_id'])
+        for (qid, errorID), k in zip(keys.tolist(), counts.tolist()):
+            get(qid).errorCounts[errorID] = k
+        keys, counts = group_counts(se['question_id'], se['uid'])
+        keys, counts = group_counts(keys['f0']) # distinct students
+        for (qid,), k in zip(keys.tolist(), counts.tolist()):
+            get(qid).nclassified = k
+        for qid, serial in self.serials.items():
+            if qlist is None or qid in d:
+                get(qid).serial = serial
+        return d
+
+    def correctness_by_confidence(self, qlist=None):
+        '''dict of {questionID: 3x3 array of response counts}, indexed
+        by [status][confidence], statuses as in QuestionStats.statuses'''
+        r = self.rows('responses', qlist)
+        r = r[(r['reasons'] != NULL) & (r['confidence'] >= 0) &
+              (r['confidence'] < 3)]
+        qids, qindex = numpy.unique(r['question_id'], return_inverse=True)
+        counts = numpy.bincount(qindex * 9 + r['reasons'] * 3 + r['confidence'],
+                                minlength=len(qids) * 9)
+        return dict(zip(qids.tolist(), counts.reshape((len(qids), 3, 3))))
+
+    def switch_rates(self, qlist=None):
+        '''dict of {questionID: (reconsidered, switched, voted, changed)}:
+        number of students who reported their answer after discussion
+        (switched_id), how many of them switched to their partner's
+        answer, how many of those cast a final vote (final_id) comparable
+        with the category of their post-discussion answer, and how many
+        of those voted for a different category.'''
+        r = self.rows('responses', qlist)
+        n = len(r)
+        if not n:
+            return {}
+        qids, qindex = numpy.unique(r['question_id'], return_inverse=True)
+        uids, uindex = numpy.unique(numpy.concatenate((r['uid'],
+                                                       r['switched_id'])),
+                                    return_inverse=True)
+        keys = qindex * len(uids) + uindex[:n] # (question, student)
+        targets = qindex * len(uids) + uindex[n:] # (question, response2)
+        order = numpy.argsort(keys)
+        i = order[numpy.searchsorted(keys, targets, sorter=order).clip(0, n - 1)]
+        cluster2 = numpy.where(keys[i] == targets, r['cluster_id'][i], NULL)
+        reconsidered = r['switched_id'] != NULL
+        switched = reconsidered & (r['switched_id'] != r['uid'])
+        voted = reconsidered & (r['final_id'] != NULL) & (cluster2 != NULL)
+        changed = voted & (r['final_id'] != cluster2)
+        counts = [numpy.bincount(qindex[x], minlength=len(qids)).tolist()
+                  for x in (reconsidered, switched, voted, changed)]
+        return dict(zip(qids.tolist(), zip(*counts)))
+
+    def error_frequencies(self, qlist=None):
+        '''dict of {questionID: [(count, errorID), ...]} for every error
+        model of each question, most common first'''
+        em = self.rows('error_models', qlist) # sorted by id
+        se = self.rows('student_errors', qlist)
+        counts = numpy.bincount(numpy.searchsorted(em['rowid'],
+                                                   se['error_id']),
+                                minlength=len(em))
+        d = {}
+        for qid, errorID, k in zip(em['question_id'].tolist(),
+                                   em['rowid'].tolist(), counts.tolist()):
+            d.setdefault(qid, []).append((k, errorID))
+        for l in d.values():
+            l.sort(reverse=True)
+        return d
@@ -7,10 +7,15 @@ import sqlite3
 import csv
 from datetime import datetime, date
 from question import questionTypes
-import random
-import Queue
+import textcluster
 import re
 import codecs
+import threading
+import multiprocessing
+import StringIO
+import hmac
+import hashlib
+import json
 
 class BadUIDError(ValueError):
     pass
@@ -18,21 +23,619 @@ class BadUIDError(ValueError):
 class BadUsernameError(ValueError):
     pass
 
+class ConnectionPool(object):
+    '''keeps one long-lived sqlite3 connection per thread for a db file.
+    Connections are opened lazily, switched to WAL journaling (so readers
+    never block the writer) and reuse their prepared statement cache.'''
+    def __init__(self, dbfile='course.db', journalMode='WAL',
+                 synchronous='NORMAL', cachedStatements=100, timeout=30.,
+                 readOnly=False):
+        self.dbfile = dbfile
+        self.readOnly = readOnly
+        self.journalMode = journalMode
+        self.synchronous = synchronous
+        self.cachedStatements = cachedStatements
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._conns = []
+
+    def connect(self):
+        'get the connection for the calling thread, opening it if needed'
+        try:
+            return self._local.conn
+        except AttributeError:
+            pass
+        conn = sqlite3.connect(self.dbfile, timeout=self.timeout,
+                               cached_statements=self.cachedStatements,
+                               check_same_thread=False) # closed by close()
+        if self.journalMode:
+            conn.execute('pragma journal_mode=%s' % self.journalMode)
+        if self.synchronous:
+            conn.execute('pragma synchronous=%s' % self.synchronous)
+        if self.readOnly: # refuse any attempt to modify the database
+            conn.execute('pragma query_only=ON')
+        self._local.conn = conn
+        with self._lock:
+            self._conns.append(conn)
+        return conn
+
+    def close(self):
+        'close every connection opened by this pool'
+        with self._lock:
+            conns = self._conns
+            self._conns = []
+        for conn in conns:
+            conn.close()
+        self._local = threading.local()
+
+_pools = {}
+_poolsLock = threading.Lock()
+
+def get_pool(dbfile='course.db', **kwargs):
+    'get the shared ConnectionPool for dbfile, creating it if needed'
+    path = os.path.abspath(dbfile)
+    with _poolsLock:
+        try:
+            return _pools[path]
+        except KeyError:
+            pool = _pools[path] = ConnectionPool(dbfile, **kwargs)
+            return pool
+
+def _serial_trigger(name, event, table, *questionIDs):
+    'SQL for trigger bumping question_changes serial of these questions'
+    body = ''
+    for qid in questionIDs:
+        body += '''insert or replace into question_changes
+        select * from (select %s as qid, coalesce(max(serial), 0) + 1
+                       from question_changes where question_id=%s)
+        where qid is not null;
+        ''' % (qid, qid)
+    return 'create trigger if not exists %s after %s on %s begin %s end' \
+           % (name, event, table, body)
+
+_errorQuestion = '(select question_id from error_models where id=%s.error_id)'
+
+# ordered schema migrations: (version, description, SQL statements).
+# Never edit a released step; append a new one with the next version.
+_migrations = (
+    (1, 'index responses by question',
+     ('create index if not exists responses_question on responses (question_id)',)),
+    (2, 'index responses by student',
+     ('create index if not exists responses_uid on responses (uid)',)),
+    (3, 'index student errors by error model and student',
+     ('create index if not exists student_errors_error_uid on student_errors (error_id, uid)',)),
+    (4, 'index error models by question',
+     ('create index if not exists error_models_question on error_models (question_id)',)),
+    (5, 'count changes to the report data of each question',
+     ('''create table if not exists question_changes
+     (question_id integer primary key,
+     serial integer)''',
+      _serial_trigger('responses_insert_serial', 'insert', 'responses',
+                      'new.question_id'),
+      _serial_trigger('responses_update_serial', 'update', 'responses',
+                      'old.question_id', 'new.question_id'),
+      _serial_trigger('responses_delete_serial', 'delete', 'responses',
+                      'old.question_id'),
+      _serial_trigger('student_errors_insert_serial', 'insert',
+                      'student_errors', _errorQuestion % 'new'),
+      _serial_trigger('student_errors_update_serial', 'update',
+                      'student_errors', _errorQuestion % 'old',
+                      _errorQuestion % 'new'),
+      _serial_trigger('student_errors_delete_serial', 'delete',
+                      'student_errors', _errorQuestion % 'old'),
+      _serial_trigger('error_models_update_serial', 'update', 'error_models',
+                      'old.question_id', 'new.question_id'))),
+    (6, 'cache rendered report sections',
+     ('''create table if not exists report_cache
+     (question_id integer,
+     options text,
+     watermark text,
+     fragment text,
+     primary key (question_id, options))''',)),
+    (7, 'store course settings such as the student code key',
+     ('''create table if not exists settings
+     (name text primary key,
+     value text)''',)),
+    (8, 'append-only log of student submissions',
+     ('''create table if not exists events
+     (id integer primary key,
+     question_id integer,
+     uid integer,
+     stage text,
+     payload text,
+     event_time real)''',
+      # also lets replayed journal submissions be ignored as duplicates
+      'create unique index if not exists events_question_time on events (question_id, event_time, uid, stage)',)),
+)
+
+def get_setting(conn, name, default=None):
+    'get value of setting, first saving default() if it is not yet set'
+    c = conn.cursor()
+    try:
+        c.execute('select value from settings where name=?', (name,))
+        t = c.fetchone()
+        if t:
+            return t[0]
+        if default is None:
+            return None
+        c.execute('insert or ignore into settings values (?,?)',
+                  (name, default()))
+        conn.commit()
+        c.execute('select value from settings where name=?', (name,))
+        return c.fetchone()[0] # whoever saved it first wins
+    finally:
+        c.close()
+
+class StudentCodes(object):
+    '''random-looking, unique code for each student UID, e.g. for
+    naming uploaded files without revealing UIDs.  A keyed Feistel
+    network permutes all 64-bit integers, so codes never collide, are
+    computed on demand in O(1) time and memory, and stay the same across
+    restarts as long as the key does.'''
+    bits = 64
+    def __init__(self, key, rounds=4):
+        self.key = str(key) # hmac needs bytes, not unicode from sqlite
+        self.rounds = rounds
+        self.half = self.bits // 2
+        self.mask = (1 << self.half) - 1
+
+    def _round(self, i, x):
+        h = hmac.new(self.key, '%d:%d' % (i, x), hashlib.sha1)
+        return int(h.hexdigest()[:16], 16) & self.mask
+
+    def code(self, uid):
+        'get the code for this UID'
+        x = uid & ((1 << self.bits) - 1) # negative UIDs wrap around
+        left, right = x >> self.half, x & self.mask
+        for i in range(self.rounds):
+            left, right = right, left ^ self._round(i, right)
+        return (left << self.half) | right
+
+def upgrade_schema(conn, migrations=_migrations):
+    'apply migrations newer than the schema version of conn, return version'
+    c = conn.cursor()
+    try:
+        c.execute('''create table if not exists schema_version
+        (version integer primary key,
+        description text,
+        date_applied integer)''')
+        c.execute('select max(version) from schema_version')
+        version = c.fetchone()[0] or 0
+        for step, description, statements in migrations:
+            if step <= version: # already applied
+                continue
+            for sql in statements:
+                c.execute(sql)
+            c.execute('insert into schema_version values (?,?,date(?))',
+                      (step, description, date.today().isoformat()))
+            conn.commit()
+            version = step
+        return version
+    except:
+        conn.rollback()
+        raise
+    finally:
+        c.close()
+
+def iter_chunks(rows, chunkSize):
+    'read rows lazily, yielding lists of up to chunkSize rows'
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunkSize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def insert_many(c, table, sql, rows):
+    '''insert rows (with NULL primary keys) using one executemany(),
+    returning their new primary keys in the same order as rows.
+    Must run inside a write transaction, so the newest ids are ours.'''
+    c.executemany(sql, rows)
+    if not rows:
+        return []
+    c.execute('select id from %s order by id desc limit ?' % table,
+              (len(rows),))
+    l = [t[0] for t in c.fetchall()]
+    l.reverse()
+    return l
+
 class DBConnection(object):
-    def __init__(self, dbfile='course.db'):
-        self.conn = sqlite3.connect(dbfile)
+    'cursor on the pooled connection to dbfile for the calling thread'
+    def __init__(self, dbfile='course.db', pool=None):
+        if pool is None:
+            pool = get_pool(dbfile)
+        self.conn = pool.connect()
         self.c = self.conn.cursor()
     def close(self):
+        'close the cursor; the connection stays open in its pool'
         self.c.close()
-        self.conn.close()
 
 class Student(object):
+    __slots__ = ('uid', 'fullname', 'username')
     def __init__(self, uid, fullname, username=None):
         self.uid = uid
         self.fullname = fullname
         self.username = username
 
-class CourseDB(object):
+class QuestionStats(object):
+    '''response and error model counts for one question, accumulated
+    from GROUP BY rows (see CourseDB.get_question_stats()) or in a
+    single pass over response rows, and shared by all the reports'''
+    statuses = ('different', 'close', 'correct')
+    def __init__(self, questionID=None):
+        self.questionID = questionID
+        self.n = 0
+        self.counts = {} # (reasons, confidence): number of responses
+        self.errorCounts = {} # errorID: number of student_errors rows
+        self.nclassified = 0 # number of students reporting error models
+        self.serial = 0 # question_changes serial, bumped by every change
+
+    def add_responses(self, reasons, confidence, count=1):
+        key = (reasons, confidence)
+        self.counts[key] = self.counts.get(key, 0) + count
+        self.n += count
+
+    def count(self, status=None, conf=None):
+        'number of responses with this status and/or confidence'
+        return sum([k for (reasons, confidence), k in self.counts.items()
+                    if (status is None or reasons == status) and
+                    (conf is None or confidence == conf)])
+
+    def count_errors(self):
+        'number of responses not self-assessed as correct'
+        return self.n - self.count('correct')
+
+    def common_errors(self):
+        'list of (count, errorID) for reported error models, most common first'
+        l = [(k, errorID) for errorID, k in self.errorCounts.items()]
+        l.sort(reverse=True)
+        return l
+
+    def watermark(self):
+        'string that changes whenever the report data for question changes'
+        return repr((self.serial, self.n, sorted(self.counts.items()),
+                     sorted(self.errorCounts.items()), self.nclassified))
+
+    def response_stats(self, n=None):
+        'break down responses by confidence and correctness, and both'
+        if n is None:
+            n = float(self.n)
+        if not n: # avoid division by zero error
+            n = 1.
+        statuses = []
+        breakdown = []
+        for status in self.statuses:
+            statuses.append((status, self.count(status) / n))
+            breakdown.append((status, [(conf, self.count(status, conf) / n)
+                                       for conf in range(3)]))
+        confidences = [(conf, self.count(conf=conf) / n) for conf in range(3)]
+        return statuses, confidences, breakdown
+
+class CourseReport(object):
+    '''RST reports on a course database.  CourseDB inherits these;
+    parallel report workers use a read-only CourseReport directly.'''
+    analytics = None # optional analytics.Analytics backend for statistics
+    def __init__(self, dbfile='course.db', readOnly=True):
+        self.dbfile = dbfile
+        self.pool = ConnectionPool(dbfile, journalMode=None,
+                                   synchronous=None, readOnly=readOnly)
+
+    def write_report(self, rstfile, qlist, title='Report', jobs=1,
+                     useCache=True, **kwargs):
+        '''write RST report on questions in qlist (default: all answered).
+        jobs > 1 renders question sections in that many worker processes,
+        each with its own read-only connection.  With useCache, sections
+        whose question data and report options are unchanged since they
+        were last rendered are reused from the report_cache table.'''
+        ifile = codecs.open(rstfile, 'w', 'utf-8')
+        print >>ifile, ('#' * len(title)) + '\n' + title + '\n' + ('#' * len(title)) + '\n'
+        c = self.pool.connect().cursor()
+        pool = None
+        try:
+            if not qlist:
+                c.execute('select distinct(question_id) from responses')
+                qlist = [t[0] for t in c.fetchall()]
+            stats = self.get_question_stats(c, qlist) # one scan for all
+            c.execute('select id, qtype, title from questions')
+            questions = dict([(t[0], t[1:]) for t in c.fetchall()])
+            sections = [(qid,) + questions[qid] + (stats[qid],)
+                        for qid in qlist]
+            options = repr(sorted(kwargs.items()))
+            cached = {}
+            if useCache:
+                cached = self.get_cached_sections(c, sections, options)
+            todo = [t for t in sections if t[0] not in cached]
+            if jobs > 1 and len(todo) > 1:
+                pool = multiprocessing.Pool(jobs, _init_report_worker,
+                                            (self.dbfile,))
+                rendered = pool.imap(_report_worker, # in question order
+                                     [(t, kwargs) for t in todo])
+            else:
+                rendered = (self.render_section(c, *t, **kwargs)
+                            for t in todo)
+            newSections = []
+            for t in sections:
+                try:
+                    section = cached[t[0]]
+                except KeyError:
+                    section = rendered.next()
+                    newSections.append((t, section))
+                ifile.write(section)
+            if useCache and newSections:
+                self.save_cached_sections(c, newSections, options)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+            c.close()
+            ifile.close()
+
+    def render_section(self, c, *args, **kwargs):
+        'return the report section for one question as a string'
+        ofile = StringIO.StringIO()
+        self.report_section(ofile, c, *args, **kwargs)
+        return ofile.getvalue()
+
+    def report_section(self, ifile, c, qid, qtype, qtitle, stats, **kwargs):
+        'write the report section for one question'
+        if qtype == 'mc':
+            self.question_report(ifile, qid, c, qtitle, 'answer',
+                                 multipleChoice=True, **kwargs)
+        else:
+            self.basic_report(ifile, qid, c, qtitle, stats=stats, **kwargs)
+
+    def get_cached_sections(self, c, sections, options):
+        'get dict of {questionID:section} for cached sections still valid'
+        watermarks = dict([(t[0], section_watermark(*t[1:])) for t in sections])
+        d = {}
+        for chunk in iter_chunks(watermarks, 500):
+            c.execute('''select question_id, watermark, fragment from report_cache
+            where options=? and question_id in (%s)''' % ','.join('?' * len(chunk)),
+                      [options] + chunk)
+            for qid, watermark, fragment in c.fetchall():
+                if watermark == watermarks[qid]:
+                    d[qid] = fragment
+        return d
+
+    def save_cached_sections(self, c, sections, options):
+        'save list of (sectionArgs, section) to the report_cache'
+        c.executemany('insert or replace into report_cache values (?,?,?,?)',
+                      [(t[0], options, section_watermark(*t[1:]), section)
+                       for t, section in sections])
+        c.connection.commit()
+
+    def get_question_stats(self, c, qlist=None):
+        '''compute QuestionStats for questions in qlist (default: all)
+        using GROUP BY queries, returning dict of {questionID:stats}'''
+        if self.analytics is not None: # vectorized NumPy backend
+            self.analytics.refresh(c)
+            return self.analytics.question_stats(qlist)
+        d = {}
+        if qlist:
+            for qid in qlist:
+                d[qid] = QuestionStats(qid)
+            chunks = iter_chunks(qlist, 500) # stay under sqlite's max args
+        else:
+            chunks = (None,)
+        def get(qid):
+            try:
+                return d[qid]
+            except KeyError:
+                stats = d[qid] = QuestionStats(qid)
+                return stats
+        for chunk in chunks:
+            if chunk:
+                where = ' and question_id in (%s)' % ','.join('?' * len(chunk))
+                args = chunk
+            else:
+                where = ''
+                args = ()
+            c.execute('''select question_id, reasons, confidence, count(*)
+            from responses where 1%s group by question_id, reasons, confidence'''
+                      % where, args)
+            for qid, reasons, confidence, k in c.fetchall():
+                get(qid).add_responses(reasons, confidence, k)
+            c.execute('''select question_id, error_id, count(*)
+            from student_errors t1, error_models t2 where t1.error_id=t2.id%s
+            group by question_id, error_id''' % where, args)
+            for qid, errorID, k in c.fetchall():
+                get(qid).errorCounts[errorID] = k
+            c.execute('''select question_id, count(distinct t1.uid)
+            from student_errors t1, error_models t2 where t1.error_id=t2.id%s
+            group by question_id''' % where, args)
+            for qid, k in c.fetchall():
+                get(qid).nclassified = k
+            c.execute('select question_id, serial from question_changes where 1%s'
+                      % where, args)
+            for qid, serial in c.fetchall():
+                get(qid).serial = serial
+        return d
+
+    def basic_report(self, ifile, qid, c, title, 
+                     confNames=('just guessing', 'not sure', 'pretty sure'),
+                     stats=None):
+        'report stats, known error models, and unclassified errors'
+        if stats is None:
+            stats = self.get_question_stats(c, (qid,))[qid]
+        commonErrors = stats.common_errors()
+        c.execute('select id,belief from error_models where question_id=?',
+                  (qid,))
+        error_models = {}
+        for errorID,belief in c.fetchall():
+            error_models[errorID] = belief
+        n = float(stats.n)
+        statuses, confidences, breakdown = stats.response_stats()
+        print >>ifile, '\n' + title + '\n' + ('-' * len(title)) + '\n\n'
+        print >>ifile, '%d Students:' % stats.n
+        l = ['%.0f%% %s' % (100 * t[1], t[0]) for t in statuses]
+        print >>ifile, ', '.join(l) + '\n'
+        l = ['%.0f%% %s' % (100 * t[1], confNames[t[0]]) for t in confidences]
+        print >>ifile, 'Confidence: ' + ', '.join(l) + '\n'
+        print >>ifile, 'Known Error Models\n......................\n'
+        for nerr, errorID in commonErrors:
+            print >>ifile, '* %.0f%%: ' % (100 * nerr / n), 
+            print >>ifile, simple_rst(error_models[errorID], '\n  ') + '\n'
+        if stats.nclassified >= stats.count_errors(): # no unclassified errors
+            return
+        print >>ifile, 'Unclassified Errors\n......................\n'
+        for status in ('different', 'close'):
+            first = True
+            c.execute('''select answer, criticisms from responses
+            where question_id=? and reasons=? and uid not in
+            (select t1.uid from student_errors t1, error_models t2
+            where t2.question_id=? and t1.error_id=t2.id) order by id''',
+                      (qid, status, qid))
+            for answer, criticisms in c.fetchall():
+                if first:
+                    print >>ifile, '\n%s\n++++++++++++\n' % status
+                    first = False
+                print >>ifile, '* ' + simple_rst(answer, '\n  ')
+                if criticisms and criticisms.strip():
+                    print >>ifile, '  **Difference**: ' + \
+                        simple_rst(criticisms, '\n  ')
+
+    def response_stats(self, responses, n):
+        'break down (uid, answer, confidence, reasons, ...) response rows'
+        stats = QuestionStats()
+        for t in responses: # single pass
+            stats.add_responses(t[3], t[2])
+        return stats.response_stats(n)
+    def question_report(self, ifile, qid, c, title, orderBy='cluster_id',
+                        showReasons=False, multipleChoice=False,
+                        correctOnly=True):
+        letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+        print >>ifile, '\n' + title + '\n' + ('-' * len(title)) + '\n\n'
+        currentID = None
+        i = 0
+        d = {}
+        critiques = {}
+        is_correct = {}
+        answer = {}
+        c.execute('select uid, cluster_id, is_correct, answer, reasons, switched_id, final_id, critique_id, criticisms from responses where question_id=? order by %s'
+                  % orderBy, (qid,))
+        order = []
+        uncategorized = []
+        for t in c.fetchall():
+            if t[1] is None: # not categorized so not usable
+                uncategorized.append(t)
+                continue
+            elif correctOnly:
+                if int(t[2]):
+                    try:
+                        d[t[1]].append(t)
+                    except KeyError:
+                        order.append(t[1])
+                        d[t[1]] = [t]
+                        is_correct[t[1]] = 'Correct'
+                else:
+                    uncategorized.append(t)
+                continue
+                    
+            try:
+                d[t[1]].append(t)
+            except KeyError:
+                order.append(t[1])
+                d[t[1]] = [t]
+                try:
+                    if int(t[2]):
+                        is_correct[t[1]] = 'Correct'
+                    else:
+                        is_correct[t[1]] = 'Wrong'
+                except TypeError:
+                    is_correct[t[1]] = 'Uncategorized'
+            if t[0] == t[1]: # prototype
+                answer[t[1]] = t[3]
+            if t[-2] == t[0]: # self-critique
+                critiqueID = t[1]
+            else:
+                critiqueID = t[-2]
+            if t[-1]:
+                try:
+                    critiques[critiqueID].append(t[-1])
+                except KeyError:
+                    critiques[critiqueID] = [t[-1]]
+        for cluster_id in order:
+            rows = d[cluster_id]
+            try:
+                a = answer[cluster_id]
+            except KeyError: # no prototype found?
+                if multipleChoice: # no need to extract a text response
+                    a = None
+                else:
+                    l = [(len(t[3]),t[3]) for t in rows]
+                    l.sort() # find the longest answer for this category
+                    a = simple_rst(l[-1][1]) # text response
+            else:
+                a = simple_rst(a) # get text response from prototype
+            s = 'Answer ' + letters[i] + ' (%s, %d people)' \
+                % (is_correct[cluster_id], len(rows))
+            i += 1
+            print >>ifile, '\n' + s + '\n' + ('.' * len(s))
+            if a: # print text response answer
+                print >>ifile, '\n' + a
+            if showReasons and rows:
+                s = 'Reasons Given for this Answer'
+                print >>ifile, '\n' + s + '\n' + ('+' * len(s)) + '\n'
+                for t in rows:
+                    if t[4]:
+                        print >>ifile, '* ' + simple_rst(t[4], '\n  ')
+            try:
+                l = critiques[cluster_id]
+            except KeyError:
+                pass
+            else:
+                s = 'Critiques of this Answer'
+                print >>ifile, '\n' + s + '\n' + ('+' * len(s)) + '\n'
+                for criticism, n in textcluster.collapse_duplicates(l):
+                    print_collapsed(ifile, criticism, n)
+        if uncategorized:
+            s = 'Uncategorized Answers (%d people)' % len(uncategorized)
+            print >>ifile, '\n' + s + '\n' + ('.' * len(s)) + '\n'
+            mismatch = frozenset([t[4] for t in uncategorized])
+            for status in mismatch:
+                answers = filter(lambda t:t[4] == status, uncategorized)
+                s = '%s (%d people)' % (status, len(answers))
+                print >>ifile, '\n' + s + '\n' + ('+' * len(s)) + '\n'
+                l = []
+                for t in answers:
+                    s = t[3] + '.  '
+                    if t[-1]:
+                        s += '**Difference:** ' + t[-1]
+                    l.append(s)
+                for s, n in textcluster.collapse_duplicates(l):
+                    print_collapsed(ifile, s, n)
+
+def print_collapsed(ifile, s, n):
+    'print one bullet for a group of n near-duplicate texts, shown by s'
+    if n > 1:
+        s = s.rstrip() + ' (%d people)' % n
+    print >>ifile, '* ' + simple_rst(s, '\n  ')
+
+_reportWorker = None # CourseReport for this report worker process
+
+def _init_report_worker(dbfile):
+    global _reportWorker
+    _reportWorker = CourseReport(dbfile)
+
+def _report_worker(args):
+    'render one write_report() section in a worker process'
+    section, kwargs = args
+    c = _reportWorker.pool.connect().cursor()
+    try:
+        return _reportWorker.render_section(c, *section, **kwargs)
+    finally:
+        c.close()
+
+_reportFormat = 3 # increment whenever report_section() output changes
+
+def section_watermark(qtype, qtitle, stats):
+    'report_cache key that changes whenever this section would change'
+    return repr((_reportFormat, qtype, qtitle)) + stats.watermark()
+
+class CourseDB(CourseReport):
     _questionSchema = (
         'question_id',
         'qtype',
@@ -71,21 +674,24 @@ class CourseDB(object):
         'confidence',
         'submit_time',
     )
+    adminUID = 0 # events uid for instructor actions, see log_event()
     def __init__(self, questionFile=None, studentFile=None,
-                 dbfile='course.db', createSchema=False, nmax=1000,
-                 enableMath=False, rootPath=''):
+                 dbfile='course.db', createSchema=False, nmax=None,
+                 enableMath=False, rootPath='', synchronous='NORMAL',
+                 questionIDs=None, pageHeader=None):
+        # nmax is obsolete: student codes are no longer preallocated
         self.dbfile = dbfile
         self.enableMath = enableMath
         self.rootPath = rootPath
+        self.pageHeader = pageHeader # <head> HTML for this course's pages
         self.logins = set()
-        codes = range(nmax)
-        random.shuffle(codes) # short but random unique IDs for students
-        self.idQueue = Queue.Queue() # thread-safe container
-        for i in codes: # each student will get one ID from the container
-            self.idQueue.put(i)
+        self._saveLock = threading.Lock()
+        self._events = [] # submissions not yet written to events table
+        self._eventsLock = threading.Lock()
         if not os.path.exists(dbfile):
             createSchema = True
-        conn = sqlite3.connect(dbfile)
+        self.pool = get_pool(dbfile, synchronous=synchronous)
+        conn = self.pool.connect()
         c = conn.cursor()
         if createSchema:
             c.execute('''create table students
@@ -130,15 +736,17 @@ class CourseDB(object):
             confidence text,
             submit_time integer)''')
             conn.commit()
+        upgrade_schema(conn) # bring older databases up to date
+        self.codes = StudentCodes(get_setting(conn, 'student_code_key',
+                                  lambda:os.urandom(16).encode('hex')))
+        self.make_student_dict(c)
         if studentFile:
             self.load_student_file(studentFile, c=c, conn=conn)
-        else:
-            self.make_student_dict(c)
         if questionFile:
             self.load_question_file(questionFile, c=c, conn=conn, 
-                                    rootPath=rootPath)
+                                    rootPath=rootPath,
+                                    questionIDs=questionIDs)
         c.close()
-        conn.close()
 
     def make_student_dict(self, c):
         'build dict from the student db'
@@ -147,7 +755,6 @@ class CourseDB(object):
         users = {}
         for t in c.fetchall():
             student = Student(*t)
-            student.code = self.idQueue.get() # get a unique random code
             d[student.uid] = student
             if student.username:
                 users[student.username] = student
@@ -156,13 +763,30 @@ class CourseDB(object):
 
     def load_student_file(self, path, **kwargs):
         'read UID,fullname CSV file'
-        self.save_csv_to_db(path, self.insert_students, self.make_student_dict,
-                            **kwargs)
+        self.save_csv_to_db(path, self.insert_students, **kwargs)
 
-    def insert_students(self, users, c):
-        for uid,fullname in users:
-            c.execute('insert into students values (?,?,NULL,date(?),"admin")',
-                      (uid, fullname, date.today().isoformat()))
+    def insert_students(self, users, c, chunkSize=1000, progress=None):
+        '''save UID,fullname rows in chunks, committing each chunk and
+        adding it to self.students.  UIDs already present are skipped,
+        so an interrupted import can simply be re-run.'''
+        today = date.today().isoformat()
+        n = 0
+        for chunk in iter_chunks(users, chunkSize):
+            new = {}
+            for uid,fullname in chunk:
+                uid = int(uid)
+                if uid not in self.students:
+                    new[uid] = fullname
+            c.executemany('insert into students values (?,?,NULL,date(?),"admin")',
+                          [(uid, fullname, today)
+                           for uid,fullname in new.items()])
+            c.connection.commit()
+            for uid,fullname in new.items():
+                student = Student(uid, fullname)
+                self.students[uid] = student
+            n += len(chunk)
+            if progress:
+                progress(n)
 
     def save_csv_to_db(self, path, func, postfunc=None, c=None, conn=None,
                        **kwargs):
@@ -170,24 +794,31 @@ class CourseDB(object):
         ifile = open(path, 'Ub')
         try:
             rows = csv.reader(ifile)
-            if not c: # need to open connection to the database
-                conn = sqlite3.connect(self.dbfile)
+            if not c: # need a cursor on our pooled connection
+                conn = self.pool.connect()
                 c = conn.cursor()
                 doClose = True
             else:
                 doClose = False
             try:
-                func(rows, c, **kwargs)
-                conn.commit()
+                try:
+                    func(rows, c, **kwargs)
+                    conn.commit()
+                except:
+                    conn.rollback() # don't leave pooled connection mid-transaction
+                    raise
                 if postfunc:
                     postfunc(c)
             finally:
-                if doClose: # need to close our connection
+                if doClose: # connection itself stays open in the pool
                     c.close()
-                    conn.close()
         finally:
             ifile.close()
 
+    def student_code(self, uid):
+        'random but unique code for this student'
+        return self.codes.code(uid)
+
     def authenticate(self, uid, username):
         'validate a login'
         try:
@@ -238,273 +869,294 @@ class CourseDB(object):
                                  (uid, fullname, username,
                                   date.today().isoformat()))
         student = Student(uid, fullname, username)
-        student.code = self.idQueue.get() # get a unique random code
         self.students[uid] = student
         self.userdict[username] = student
         return 'Added user ' + username
 
     def _execute_and_commit(self, sql, args):
         'execute a change to the db and commit it'
-        conn = sqlite3.connect(self.dbfile)
+        conn = self.pool.connect()
         c = conn.cursor()
         try:
             c.execute(sql, args)
             conn.commit()
+        except:
+            conn.rollback()
+            raise
         finally:
             c.close()
-            conn.close()
 
     def load_question_file(self, path, **kwargs):
         'read from CSV file to self.questions, and save to database'
+        kwargs.setdefault('rootPath', self.rootPath)
         self.save_csv_to_db(path, self.insert_questions, **kwargs)
 
-    def insert_questions(self, questions, c, rootPath=''):
+    def insert_questions(self, questions, c, rootPath='', questionIDs=None,
+                         chunkSize=1000, progress=None):
+        '''save question rows in chunks, committing each chunk.
+        questionIDs: optional list of (questionID, errorIDs) previously
+        saved for these questions, e.g. when recovering a crashed session'''
+        today = date.today().isoformat()
         l = []
-        for t in questions:
-            c.execute('insert into questions values (NULL,?,?,date(?))',
-                      (t[0], t[1], date.today().isoformat()))
-            klass = questionTypes[t[0]]
-            q = klass(c.lastrowid, enableMath=self.enableMath, 
-                      rootPath=rootPath, *t[1:])
-            q.courseDB = self
-            q.errorIDs = []
-            for e in q.errorModels:
-                c.execute('insert into error_models values (NULL,?,?,NULL,NULL,date(?))',
-                          (q.id, e, date.today().isoformat()))
-                q.errorIDs.append(c.lastrowid)
-            l.append(q)
+        for chunk in iter_chunks(questions, chunkSize):
+            if questionIDs: # reuse existing rows for these questions
+                ids = questionIDs[len(l):len(l) + len(chunk)]
+                if len(ids) < len(chunk):
+                    raise ValueError('more questions than the %d saved IDs'
+                                     % len(questionIDs))
+            else:
+                qids = insert_many(c, 'questions',
+                                   'insert into questions values (NULL,?,?,date(?))',
+                                   [(t[0], t[1], today) for t in chunk])
+                ids = [(qid, None) for qid in qids]
+            newQuestions = []
+            errorRows = []
+            for t,(qid, errorIDs) in zip(chunk, ids):
+                klass = questionTypes[t[0]]
+                q = klass(qid, enableMath=self.enableMath, 
+                          rootPath=rootPath, pageHeader=self.pageHeader,
+                          *t[1:])
+                q.courseDB = self
+                if errorIDs is None: # need to save its error models
+                    newQuestions.append(q)
+                    errorRows += [(q.id, e, today) for e in q.errorModels]
+                else:
+                    q.errorIDs = list(errorIDs)
+                l.append(q)
+            errorIDs = insert_many(c, 'error_models',
+                                   'insert into error_models values (NULL,?,?,NULL,NULL,date(?))',
+                                   errorRows)
+            for q in newQuestions: # assign error IDs in order
+                q.errorIDs = errorIDs[:len(q.errorModels)]
+                errorIDs = errorIDs[len(q.errorModels):]
+            c.connection.commit()
+            if progress:
+                progress(len(l))
+        if questionIDs and len(l) != len(questionIDs):
+            raise ValueError('%d questions do not match the %d saved IDs'
+                             % (len(l), len(questionIDs)))
         self.questions = l
 
     def save_responses(self, question):
-        'save all responses to this question to the database'
+        '''save new or changed responses to this question to the database.
+        Only responses whose version changed since their last save are
+        written, each kind in a single executemany() batch.'''
         def get_id(r, attr): # return None or the object's db id
             resp = getattr(r, attr, None)
             if resp:
                 return resp.uid
-        conn = sqlite3.connect(self.dbfile)
+        with self._saveLock: # concurrent saves would insert duplicate rows
+            dirty = [(r, r.version, list(getattr(r, 'errorIDs', ())))
+                     for r in question.responses.values()
+                     if r.version != r.savedVersion]
+            if not dirty: # nothing changed since last save
+                return len(question.responses)
+            updates = []
+            inserts = []
+            errors = []
+            staleErrors = [] # students whose saved errors have changed
+            for r, version, errorIDs in dirty:
+                submitTime = datetime.fromtimestamp(r.timestamp) \
+                             .isoformat().split('.')[0]
+                row = (getattr(r, 'id', None),
+                       r.uid, question.id, get_id(r, 'prototype'),
+                       question.is_correct(r),
+                       r.get_answer(), getattr(r, 'path', None),
+                       r.confidence,
+                       submitTime,
+                       getattr(r, 'reasons', None),
+                       get_id(r, 'response2'),
+                       getattr(r, 'confidence2', None),
+                       get_id(r, 'finalVote'),
+                       getattr(r, 'finalConfidence', None),
+                       get_id(r, 'critiqueTarget'),
+                       getattr(r, 'criticisms', None))
+                if hasattr(r, 'id'):
+                    updates.append(row)
+                else:
+                    inserts.append(row)
+                if sorted(errorIDs) != sorted(getattr(r, 'savedErrorIDs', ())):
+                    if hasattr(r, 'id'): # replace its saved errors
+                        staleErrors.append((r.uid,))
+                    for e in errorIDs:
+                        errors.append((e, r.uid, submitTime))
+            sql = '''insert or replace into responses values
+            (?,?,?,?,?,?,?,?,datetime(?),?,?,?,?,?,?,?)'''
+            conn = self.pool.connect()
+            c = conn.cursor()
+            try:
+                c.executemany(sql, updates)
+                rowIDs = dict(zip([row[1] for row in inserts],
+                                  insert_many(c, 'responses', sql, inserts)))
+                if staleErrors and question.errorIDs:
+                    c.executemany('''delete from student_errors
+                    where uid=? and error_id in (%s)'''
+                                  % ','.join(['%d' % e for e in
+                                              question.errorIDs]),
+                                  staleErrors)
+                c.executemany('''insert into student_errors values
+                                 (?,?,NULL,NULL,datetime(?))''', errors)
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+            finally:
+                c.close()
+            for r, version, errorIDs in dirty:
+                if not hasattr(r, 'id'): # record its primary key
+                    r.id = rowIDs[r.uid]
+                r.savedErrorIDs = errorIDs
+                r.savedVersion = version
+        return len(question.responses) # number of saved responses
+
+    def log_event(self, questionID, uid, stage, args, eventTime,
+                  batchSize=100):
+        '''queue a student submission (or, with uid=adminUID, an
+        instructor action from question.adminStages) for the events
+        table, writing the queue in one batch whenever it reaches
+        batchSize rows'''
+        with self._eventsLock:
+            self._events.append((questionID, uid, stage, json.dumps(args),
+                                 eventTime))
+            n = len(self._events)
+        if n >= batchSize:
+            self.flush_events()
+
+    def flush_events(self):
+        'write queued submissions to the events table, return their number'
+        with self._eventsLock:
+            rows = self._events
+            self._events = []
+        if not rows:
+            return 0
+        conn = self.pool.connect()
         c = conn.cursor()
-        n = 0
         try:
-            saved = []
-            for r in question.responses.values(): # insert rows
-                dt = datetime.fromtimestamp(r.timestamp)
-                c.execute('''insert or replace into responses values
-                (?,?,?,?,?,?,?,?,datetime(?),?,?,?,?,?,?,?)''',
-                          (getattr(r, 'id', None),
-                           r.uid, question.id, get_id(r, 'prototype'),
-                           question.is_correct(r),
-                           r.get_answer(), getattr(r, 'path', None),
-                           r.confidence,
-                           dt.isoformat().split('.')[0],
-                           getattr(r, 'reasons', None),
-                           get_id(r, 'response2'),
-                           getattr(r, 'confidence2', None),
-                           get_id(r, 'finalVote'),
-                           getattr(r, 'finalConfidence', None),
-                           get_id(r, 'critiqueTarget'),
-                           getattr(r, 'criticisms', None)))
-                saved.append((r, c.lastrowid))
-                if not hasattr(r, 'id'): # save student's reported errors
-                    for e in getattr(r, 'errorIDs', ()):
-                        c.execute('''insert into student_errors values 
-                                     (?,?,NULL,NULL,datetime(?))''',
-                                  (e, r.uid, dt.isoformat().split('.')[0]))
+            c.executemany('''insert or ignore into events
+            (question_id, uid, stage, payload, event_time)
+            values (?,?,?,?,?)''', rows)
             conn.commit()
-            for r,rowID in saved: # record commited row IDs
-                r.id = rowID # record its primary key
-            n = len(question.responses)
+        except:
+            conn.rollback()
+            with self._eventsLock: # keep them for the next flush
+                self._events[:0] = rows
+            raise
         finally:
             c.close()
-            conn.close()
-        return n # number of saved responses
+        return len(rows)
 
-    def write_report(self, rstfile, qlist, title='Report', **kwargs):
-        ifile = codecs.open(rstfile, 'w', 'utf-8')
-        print >>ifile, ('#' * len(title)) + '\n' + title + '\n' + ('#' * len(title)) + '\n'
-        conn = sqlite3.connect(self.dbfile)
-        c = conn.cursor()
+    def replay_events(self, question, until=None, questionID=None):
+        '''rebuild the state of a freshly loaded question by replaying
+        logged submissions and instructor actions to questionID (default:
+        question.id) in order, up to time until (default: all).
+        Returns the number of events replayed.'''
+        self.flush_events()
+        question.courseDB = self
+        if questionID is None:
+            questionID = question.id
+        sql = '''select uid, stage, payload from events
+        where question_id=?'''
+        args = [questionID]
+        if until is not None:
+            sql += ' and event_time<=?'
+            args.append(until)
+        c = self.pool.connect().cursor()
         try:
-            if not qlist:
-                c.execute('select distinct(question_id) from responses')
-                qlist = [t[0] for t in c.fetchall()]
-            for qid in qlist:
-                c.execute('select qtype, title from questions where id=?',
-                          (qid,))
-                qtype, qtitle = c.fetchall()[0]
-                if qtype == 'mc':
-                    self.question_report(ifile, qid, c, qtitle, 'answer',
-                                         multipleChoice=True, **kwargs)
+            c.execute(sql + ' order by event_time, id', args)
+            n = 0
+            for uid, stage, payload in c:
+                if uid == self.adminUID:
+                    try:
+                        action = question.adminStages[stage]
+                    except KeyError: # not an action of this question type
+                        continue
+                    action(**json.loads(payload))
                 else:
-                    self.basic_report(ifile, qid, c, qtitle, **kwargs)
+                    try:
+                        action = question.submitStages[stage]
+                    except KeyError: # not a stage of this question type
+                        continue
+                    action(uid, **json.loads(payload))
+                n += 1
         finally:
             c.close()
-            conn.close()
-            ifile.close()
-    def basic_report(self, ifile, qid, c, title, 
-                     confNames=('just guessing', 'not sure', 'pretty sure')):
-        'report stats, known error models, and unclassified errors'
-        c.execute('select t1.error_id,t1.uid from student_errors t1, error_models t2 where t2.question_id=? and t1.error_id=t2.id',
-                  (qid,))
-        student_errors = c.fetchall()
-        classifiedErrors = frozenset([t[1] for t in student_errors])
-        commonErrors = frozenset([t[0] for t in student_errors])
-        commonErrors = [(len([t for t in student_errors if t[0] == errorID]), 
-                         errorID) for errorID in commonErrors]
-        commonErrors.sort(reverse=True)
-        c.execute('select id,belief from error_models where question_id=?',
-                  (qid,))
-        error_models = {}
-        for errorID,belief in c.fetchall():
-            error_models[errorID] = belief
-        c.execute('select uid, answer, confidence, reasons, criticisms from responses where question_id=?',
-                  (qid,))
-        responses = c.fetchall()
-        n = float(len(responses))
-        nerror = len([t for t in responses if t[3] != 'correct'])
-        statuses, confidences, breakdown = self.response_stats(responses, n)
-        print >>ifile, '\n' + title + '\n' + ('-' * len(title)) + '\n\n'
-        print >>ifile, '%d Students:' % len(responses)
-        l = ['%.0f%% %s' % (100 * t[1], t[0]) for t in statuses]
-        print >>ifile, ', '.join(l) + '\n'
-        l = ['%.0f%% %s' % (100 * t[1], confNames[t[0]]) for t in confidences]
-        print >>ifile, 'Confidence: ' + ', '.join(l) + '\n'
-        print >>ifile, 'Known Error Models\n......................\n'
-        for nerr, errorID in commonErrors:
-            print >>ifile, '* %.0f%%: ' % (100 * nerr / n), 
-            print >>ifile, simple_rst(error_models[errorID], '\n  ') + '\n'
-        if len(classifiedErrors) >= nerror: # no unclassified errors
-            return
-        print >>ifile, 'Unclassified Errors\n......................\n'
-        for status in ('different', 'close'):
-            first = True
-            for uid, answer, confidence, reasons, criticisms in responses:
-                if reasons == status and uid not in classifiedErrors:
-                    if first:
-                        print >>ifile, '\n%s\n++++++++++++\n' % status
-                        first = False
-                    print >>ifile, '* ' + simple_rst(answer, '\n  ')
-                    if criticisms and criticisms.strip():
-                        print >>ifile, '  **Difference**: ' + \
-                            simple_rst(criticisms, '\n  ')
+        return n
 
-    def response_stats(self, responses, n):
-        'break down responses by confidence and correctness, and both'
-        statuses = []
-        breakdown = []
-        for status in ('different', 'close', 'correct'):
-            l = []
-            statuses.append((status, len([t for t in responses
-                                          if t[3] == status]) / n))
-            for conf in range(3):
-                l.append((conf, len([t for t in responses
-                                     if t[2] == conf and t[3] == status]) / n))
-            breakdown.append((status, l))
-        confidences = []
-        for conf in range(3):
-            confidences.append((conf, len([t for t in responses
-                                           if t[2] ==  conf]) / n))
-        return statuses, confidences, breakdown
-    def question_report(self, ifile, qid, c, title, orderBy='cluster_id',
-                        showReasons=False, multipleChoice=False,
-                        correctOnly=True):
-        letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
-        print >>ifile, '\n' + title + '\n' + ('-' * len(title)) + '\n\n'
-        currentID = None
-        i = 0
-        d = {}
-        critiques = {}
-        is_correct = {}
-        answer = {}
-        c.execute('select uid, cluster_id, is_correct, answer, reasons, switched_id, final_id, critique_id, criticisms from responses where question_id=? order by %s'
-                  % orderBy, (qid,))
-        order = []
-        uncategorized = []
-        for t in c.fetchall():
-            if t[1] is None: # not categorized so not usable
-                uncategorized.append(t)
-                continue
-            elif correctOnly:
-                if int(t[2]):
-                    try:
-                        d[t[1]].append(t)
-                    except KeyError:
-                        order.append(t[1])
-                        d[t[1]] = [t]
-                        is_correct[t[1]] = 'Correct'
-                else:
-                    uncategorized.append(t)
-                continue
-                    
-            try:
-                d[t[1]].append(t)
-            except KeyError:
-                order.append(t[1])
-                d[t[1]] = [t]
-                try:
-                    if int(t[2]):
-                        is_correct[t[1]] = 'Correct'
-                    else:
-                        is_correct[t[1]] = 'Wrong'
-                except TypeError:
-                    is_correct[t[1]] = 'Uncategorized'
-            if t[0] == t[1]: # prototype
-                answer[t[1]] = t[3]
-            if t[-2] == t[0]: # self-critique
-                critiqueID = t[1]
-            else:
-                critiqueID = t[-2]
-            if t[-1]:
-                try:
-                    critiques[critiqueID].append(t[-1])
-                except KeyError:
-                    critiques[critiqueID] = [t[-1]]
-        for cluster_id in order:
-            rows = d[cluster_id]
-            try:
-                a = answer[cluster_id]
-            except KeyError: # no prototype found?
-                if multipleChoice: # no need to extract a text response
-                    a = None
-                else:
-                    l = [(len(t[3]),t[3]) for t in rows]
-                    l.sort() # find the longest answer for this category
-                    a = simple_rst(l[-1][1]) # text response
-            else:
-                a = simple_rst(a) # get text response from prototype
-            s = 'Answer ' + letters[i] + ' (%s, %d people)' \
-                % (is_correct[cluster_id], len(rows))
-            i += 1
-            print >>ifile, '\n' + s + '\n' + ('.' * len(s))
-            if a: # print text response answer
-                print >>ifile, '\n' + a
-            if showReasons and rows:
-                s = 'Reasons Given for this Answer'
-                print >>ifile, '\n' + s + '\n' + ('+' * len(s)) + '\n'
-                for t in rows:
-                    if t[4]:
-                        print >>ifile, '* ' + simple_rst(t[4], '\n  ')
+
+class CourseRouter(object):
+    '''maps course / section keys (e.g. "chem101-s2") to separate
+    database files in one directory, so each course has its own write
+    lock and its own (smaller) tables.  Each CourseDB is opened the
+    first time its course is requested.'''
+    _keyPattern = re.compile(r'^\w[\w.-]*$') # no path separators
+    def __init__(self, dbdir='.', suffix='.db'):
+        self.dbdir = dbdir
+        self.suffix = suffix
+        self.courseDBs = {}
+        self._lock = threading.Lock()
+
+    def dbfile(self, course):
+        'path of the database file for this course key'
+        if not self._keyPattern.match(course) or course.endswith('.'):
+            raise ValueError('bad course key: %s' % course)
+        return os.path.join(self.dbdir, course + self.suffix)
+
+    def courses(self):
+        'sorted list of course keys that already have a database file'
+        l = []
+        for filename in os.listdir(self.dbdir):
+            if filename.endswith(self.suffix):
+                course = filename[:-len(self.suffix)]
+                if self._keyPattern.match(course):
+                    l.append(course)
+        l.sort()
+        return l
+
+    def get(self, course, *args, **kwargs):
+        '''return CourseDB for this course, opening it if needed;
+        args, kwargs are passed to CourseDB() only when it is opened'''
+        with self._lock:
             try:
-                l = critiques[cluster_id]
+                return self.courseDBs[course]
             except KeyError:
                 pass
-            else:
-                s = 'Critiques of this Answer'
-                print >>ifile, '\n' + s + '\n' + ('+' * len(s)) + '\n'
-                for criticism in l:
-                    print >>ifile, '* ' + simple_rst(criticism, '\n  ')
-        if uncategorized:
-            s = 'Uncategorized Answers (%d people)' % len(uncategorized)
-            print >>ifile, '\n' + s + '\n' + ('.' * len(s)) + '\n'
-            mismatch = frozenset([t[4] for t in uncategorized])
-            for status in mismatch:
-                answers = filter(lambda t:t[4] == status, uncategorized)
-                s = '%s (%d people)' % (status, len(answers))
-                print >>ifile, '\n' + s + '\n' + ('+' * len(s)) + '\n'
-                for t in answers:
-                    s = t[3] + '.  '
-                    if t[-1]:
-                        s += '**Difference:** ' + t[-1]
-                    print >>ifile, '* ' + simple_rst(s, '\n  ')
+            kwargs['dbfile'] = self.dbfile(course)
+            courseDB = self.courseDBs[course] = CourseDB(*args, **kwargs)
+            return courseDB
+
+    def dbfiles(self, course=None):
+        'list of (course, dbfile) for one course, or all courses if None'
+        if course is not None:
+            return [(course, self.dbfile(course))]
+        return [(k, self.dbfile(k)) for k in self.courses()]
+
+
+def add_course_options(parser):
+    'add options for choosing one course database, or all of them'
+    parser.add_option('-d', '--dbfile', default='course.db',
+                      help='course database file [default: %default]')
+    parser.add_option('--course', metavar='KEY',
+                      help='use the database for course KEY in --dbdir')
+    parser.add_option('--all-courses', action='store_true', default=False,
+                      help='repeat for every course database in --dbdir')
+    parser.add_option('--dbdir', default='.', metavar='DIR',
+                      help='directory of per-course databases [default: %default]')
+
+def course_dbfiles(parser, options, mustExist=True):
+    'list of (course, dbfile) selected by add_course_options()'
+    if options.course and options.all_courses:
+        parser.error('--course and --all-courses are mutually exclusive')
+    if not options.course and not options.all_courses:
+        return [(None, options.dbfile)]
+    router = CourseRouter(options.dbdir)
+    try:
+        l = router.dbfiles(options.course)
+    except ValueError, e:
+        parser.error(str(e))
+    for course, dbfile in l:
+        if mustExist and not os.path.exists(dbfile):
+            parser.error('no database %s for course %s' % (dbfile, course))
+    return l
 
 
 def simple_rst(s, lineStart='\n'):
@@ -518,11 +1170,31 @@ def simple_rst(s, lineStart='\n'):
 
 
 def main():
-    'add students to (new) course database'
+    'add students (and optionally questions) to (new) course database'
+    from optparse import OptionParser
     import sys
-    if len(sys.argv) < 2:
-        print 'Usage: %s STUDENTFILE.csv' % sys.argv[0]
-    CourseDB(studentFile=sys.argv[1]) # insert students into default DB
+    parser = OptionParser(usage='%prog [options] STUDENTFILE.csv')
+    parser.add_option('-q', '--questions', metavar='QUESTIONFILE.csv',
+                      help='also import questions from this CSV file')
+    add_course_options(parser)
+    parser.add_option('-c', '--chunk-size', type='int', default=1000,
+                      help='rows per executemany / commit [default: %default]')
+    options, args = parser.parse_args()
+    if not args and not options.questions:
+        parser.error('no STUDENTFILE.csv or --questions given')
+    if options.all_courses:
+        parser.error('--all-courses cannot be used for importing')
+    course, dbfile = course_dbfiles(parser, options, mustExist=False)[0]
+    def progress(n):
+        sys.stdout.write('\r%d rows imported' % n)
+        sys.stdout.flush()
+    courseDB = CourseDB(dbfile=dbfile)
+    for path, func in ((args and args[0], courseDB.load_student_file),
+                       (options.questions, courseDB.load_question_file)):
+        if path:
+            print 'importing', path
+            func(path, chunkSize=options.chunk_size, progress=progress)
+            print
 
 if __name__ == '__main__':
     main()
@@ -1,7 +1,10 @@
 import json
 import codecs
+import gzip
+import os
+import errno
 import coursedb
-import random
+import time
 
 def generate_dict(rows, columns):
     'generate dict containing non-null attrs for each row'
@@ -12,25 +15,54 @@ def generate_dict(rows, columns):
                 d[field] = row[i]
         yield d
 
-def anonymize_responses(questions):
-    'remove uid from responses and student_errors, replace with random username'
-    anon = {}
+def read_salt(path):
+    '''get the secret pseudonym key stored in path, first creating it
+    (readable only by its owner) if it does not exist'''
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    else:
+        try:
+            os.write(fd, os.urandom(16).encode('hex') + '\n')
+        finally:
+            os.close(fd)
+    ifile = open(path, 'rb')
+    try:
+        return ifile.read().strip()
+    finally:
+        ifile.close()
+
+def anonymize_responses(questions, codes=None):
+    '''remove uid from responses and student_errors, replace with a
+    pseudonym computed from the uid by codes (a coursedb.StudentCodes),
+    so the same student always gets the same, unique username for a
+    given key.  Returns list of the usernames.  Default: a random key.'''
+    if codes is None:
+        codes = coursedb.StudentCodes(os.urandom(16).encode('hex'))
+    usernames = set()
     for q in questions:
         for r in q['responses']:
-            uid = r['uid']
-            try:
-                username = anon[uid]
-            except KeyError:
-                username = anon[uid] = 'user%d' % random.randint(0, 1000000000)
+            username = 'user%d' % codes.code(r['uid'])
             del r['uid']
             r['username'] = username
+            usernames.add(username)
             for se in r['errors']:
                 del se['uid']
-    return anon.values()
+    return list(usernames)
         
+def print_timing(phase, start):
+    'report time since start for this export phase, return current time'
+    t = time.time()
+    print '%s: %.2f sec' % (phase, t - start)
+    return t
+
 def get_orct_data(dbconn, anonymize=True,
-                  selfevals=('correct', 'close', 'different')):
-    'get list of question dicts w/ associated responses etc.'
+                  selfevals=('correct', 'close', 'different'), codes=None):
+    '''get list of question dicts w/ associated responses etc.
+    codes: StudentCodes for anonymizing, see anonymize_responses()'''
+    t = time.time()
     dbconn.c.execute('select * from questions') # get all questions
     questions = {}
     for q in generate_dict(dbconn.c.fetchall(),
@@ -38,7 +70,9 @@ def get_orct_data(dbconn, anonymize=True,
         q['responses'] = [] # default: no responses
         q['errors'] = [] # default: no error models
         questions[q['question_id']] = q
+    t = print_timing('questions', t)
     dbconn.c.execute('select * from responses') # add response to each question
+    responses = {} # (question_id, uid): first response by that student
     for r in generate_dict(dbconn.c.fetchall(),
                            coursedb.CourseDB._responseSchema):
         if r.get('reasons', 'SKIP') in selfevals:
@@ -46,6 +80,8 @@ def get_orct_data(dbconn, anonymize=True,
         r['errors'] = [] # default: no error models
         q = questions[r['question_id']]
         q['responses'].append(r)
+        responses.setdefault((r['question_id'], r.get('uid')), r)
+    t = print_timing('responses', t)
     errors = {}
     dbconn.c.execute('select * from error_models') # add EM to each question
     for em in generate_dict(dbconn.c.fetchall(),
@@ -53,20 +89,22 @@ def get_orct_data(dbconn, anonymize=True,
         q = questions[em['question_id']]
         q['errors'].append(em)
         errors[em['error_id']] = em
+    t = print_timing('error models', t)
     dbconn.c.execute('select * from student_errors') # add SE to each response
     n = 0
     for se in generate_dict(dbconn.c.fetchall(),
                            coursedb.CourseDB._studentErrorSchema):
         em = errors[se['error_id']]
-        q = questions[em['question_id']]
-        for r in q['responses']:
-            if r['uid'] == se['uid']: # same student
-                r['errors'].append(se)
-                n += 1
-                break
+        try: # same student's response to this question
+            r = responses[(em['question_id'], se.get('uid'))]
+        except KeyError:
+            continue
+        r['errors'].append(se)
+        n += 1
     print 'saved %d student errors' % n
+    t = print_timing('student errors', t)
     if anonymize:
-        usernames = anonymize_responses(questions.values())
+        usernames = anonymize_responses(questions.values(), codes)
     else:
         usernames = ()
     dates = {} # group questions by date
@@ -77,19 +115,242 @@ def get_orct_data(dbconn, anonymize=True,
     datelist = list(dates)
     datelist.sort()
     qlist = [dates[date] for date in datelist]
+    print_timing('anonymize and sort', t)
     return qlist, usernames
 
-def export_orct_data(dbfile='course.db', **kwargs):
-    'save ORCT response data in JSON format'
+def iter_orct_questions(dbconn, selfevals=('correct', 'close', 'different'),
+                        since=None, questionIDs=None):
+    '''generate question dicts w/ associated responses etc. in date order,
+    loading one question's rows at a time (same dicts as get_orct_data()).
+    since: only questions added on or after this date (YYYY-MM-DD);
+    questionIDs: only these questions.'''
+    qc = dbconn.conn.cursor() # walks questions while dbconn.c gets rows
+    try:
+        if since:
+            qc.execute('''select * from questions where date_added>=?
+            order by date_added, id''', (since,))
+        else:
+            qc.execute('select * from questions order by date_added, id')
+        for q in generate_dict(qc, coursedb.CourseDB._questionSchema):
+            qid = q['question_id']
+            if questionIDs is not None and qid not in questionIDs:
+                continue
+            dbconn.c.execute('''select * from error_models
+            where question_id=? order by id''', (qid,))
+            q['errors'] = list(generate_dict(dbconn.c,
+                                             coursedb.CourseDB._errorSchema))
+            dbconn.c.execute('''select * from responses
+            where question_id=? order by id''', (qid,))
+            q['responses'] = []
+            responses = {} # uid: first response by that student
+            for r in generate_dict(dbconn.c,
+                                   coursedb.CourseDB._responseSchema):
+                if r.get('reasons', 'SKIP') in selfevals:
+                    r['selfeval'] = r['reasons']
+                r['errors'] = []
+                q['responses'].append(r)
+                responses.setdefault(r.get('uid'), r)
+            dbconn.c.execute('''select t1.* from student_errors t1,
+            error_models t2 where t1.error_id=t2.id and t2.question_id=?
+            order by t1.rowid''', (qid,))
+            for se in generate_dict(dbconn.c,
+                                    coursedb.CourseDB._studentErrorSchema):
+                try:
+                    responses[se.get('uid')]['errors'].append(se)
+                except KeyError:
+                    pass
+            yield q
+    finally:
+        qc.close()
+
+def stream_orct_data(dbconn, ofile, anonymize=True, ndjson=False, codes=None,
+                     **kwargs):
+    '''write ORCT data to ofile one question at a time, so memory use is
+    bounded by the largest question.  The JSON output has the same
+    structure as export_orct_data(); with ndjson, each line is instead
+    one record: a question (with its error models), then each of its
+    responses, and finally the list of usernames.
+    codes: StudentCodes for anonymizing, see anonymize_responses()'''
+    if anonymize and codes is None: # same random key for every question
+        codes = coursedb.StudentCodes(os.urandom(16).encode('hex'))
+    usernames = set() # those in this export
+    date = first = None
+    n = 0
+    if not ndjson:
+        ofile.write('{"questions": [')
+    for q in iter_orct_questions(dbconn, **kwargs):
+        if anonymize:
+            usernames.update(anonymize_responses((q,), codes))
+        n += len(q['responses'])
+        if ndjson:
+            responses = q.pop('responses')
+            ofile.write(json.dumps(dict(q, record='question')) + '\n')
+            for r in responses:
+                ofile.write(json.dumps(dict(r, record='response')) + '\n')
+            continue
+        if first is None: # start first list of questions
+            ofile.write('[')
+        elif q.get('date_added') != date: # start list for new date
+            ofile.write('], [')
+        else:
+            ofile.write(', ')
+        first = False
+        date = q.get('date_added')
+        json.dump(q, ofile)
+    usernames = list(usernames)
+    if ndjson:
+        ofile.write(json.dumps(dict(record='usernames',
+                                    usernames=usernames)) + '\n')
+    else:
+        if first is not None:
+            ofile.write(']')
+        ofile.write('], "usernames": %s}' % json.dumps(usernames))
+    return n
+
+def get_watermark(dbconn):
+    'current extent of the data, to detect what changes after an export'
+    c = dbconn.c
+    c.execute('select max(id), max(date_added) from questions')
+    maxQuestionID, maxDate = c.fetchone()
+    c.execute('select max(id) from responses')
+    maxResponseID = c.fetchone()[0]
+    c.execute('select max(rowid) from student_errors')
+    maxStudentErrorRowid = c.fetchone()[0]
+    c.execute('select question_id, serial from question_changes')
+    return dict(maxQuestionID=maxQuestionID or 0, maxDate=maxDate,
+                maxResponseID=maxResponseID or 0,
+                maxStudentErrorRowid=maxStudentErrorRowid or 0,
+                serials=dict(c.fetchall()))
+
+def changed_question_ids(dbconn, old, new):
+    'set of IDs of questions added or changed between two watermarks'
+    qids = set([qid for qid, serial in new['serials'].items()
+                if old['serials'].get(qid) != serial])
+    c = dbconn.c
+    c.execute('select id from questions where id>?', (old['maxQuestionID'],))
+    qids.update([t[0] for t in c.fetchall()])
+    c.execute('select distinct question_id from responses where id>?',
+              (old['maxResponseID'],))
+    qids.update([t[0] for t in c.fetchall()])
+    c.execute('''select distinct t2.question_id from student_errors t1,
+    error_models t2 where t1.error_id=t2.id and t1.rowid>?''',
+              (old['maxStudentErrorRowid'],))
+    qids.update([t[0] for t in c.fetchall()])
+    return qids
+
+def read_export_state(path):
+    'get {watermark} saved by the last export, or None'
+    try:
+        ifile = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        state = json.load(ifile)
+    finally:
+        ifile.close()
+    # JSON keys are always strings, but ours are integer IDs
+    if state['watermark']:
+        state['watermark']['serials'] = dict(
+            [(int(k), v) for k, v in state['watermark']['serials'].items()])
+    return state
+
+def save_export_state(path, state):
+    ofile = open(path + '.tmp', 'wb')
+    try:
+        json.dump(state, ofile)
+    finally:
+        ofile.close()
+    os.rename(path + '.tmp', path) # never leave a partial file
+
+def export_orct_data(dbfile='course.db', stream=False, ndjson=False,
+                     compress=False, delta=False, since=None, saltFile=None,
+                     **kwargs):
+    '''save ORCT response data in JSON format.  stream (or ndjson)
+    writes it one question at a time; compress writes gzip output.
+    delta exports only questions added or changed since the last export
+    (each in full, replacing its earlier copy; see DBFILE.export.json);
+    since exports only questions added on or after that date.
+    Usernames are keyed hashes of UIDs, so they stay the same in every
+    export that uses the same secret saltFile (default: DBFILE.salt).'''
+    if saltFile is None:
+        saltFile = dbfile + '.salt'
+    codes = coursedb.StudentCodes(read_salt(saltFile))
     dbconn = coursedb.DBConnection(dbfile)
-    outfile = dbfile + '.json'
+    coursedb.upgrade_schema(dbconn.conn) # add indexes used by our queries
+    statePath = dbfile + '.export.json'
+    state = read_export_state(statePath) or dict(watermark=None)
+    watermark = get_watermark(dbconn) # before reading any rows
+    if delta and state['watermark']:
+        kwargs['questionIDs'] = changed_question_ids(dbconn,
+                                                     state['watermark'],
+                                                     watermark)
+        print '%d questions changed since last export' \
+              % len(kwargs['questionIDs'])
+    elif delta:
+        print 'no previous export watermark, so exporting everything'
+    if since:
+        kwargs['since'] = since
+    outfile = dbfile
+    if delta:
+        outfile += '.delta'
+    if ndjson:
+        outfile += '.ndjson'
+    else:
+        outfile += '.json'
+    if compress:
+        outfile += '.gz'
+        ofile = codecs.getwriter('utf-8')(gzip.open(outfile, 'wb'))
+    else:
+        ofile = codecs.open(outfile, 'w', encoding='utf-8')
     print 'writing', outfile
-    questions, usernames = get_orct_data(dbconn, **kwargs)
-    data = dict(questions=questions, usernames=usernames)
-    with codecs.open(outfile, 'w', encoding='utf-8') as ofile:
-        json.dump(data, ofile)
+    try:
+        if stream or ndjson or delta or since:
+            t = time.time()
+            n = stream_orct_data(dbconn, ofile, ndjson=ndjson,
+                                 codes=codes, **kwargs)
+            print_timing('wrote %d responses' % n, t)
+        else:
+            questions, usernames = get_orct_data(dbconn, codes=codes,
+                                                 **kwargs)
+            data = dict(questions=questions, usernames=usernames)
+            t = time.time()
+            json.dump(data, ofile)
+            print_timing('write JSON', t)
+    finally:
+        ofile.close()
+    if not since: # everything changed up to watermark has been exported
+        state['watermark'] = watermark
+    save_export_state(statePath, state)
     dbconn.close()
     
+def main():
+    'export one course database, or every course in --dbdir'
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] [DBFILE]')
+    coursedb.add_course_options(parser)
+    parser.add_option('--no-anonymize', action='store_false',
+                      dest='anonymize', default=True,
+                      help='keep student UIDs in the output')
+    parser.add_option('--stream', action='store_true', default=False,
+                      help='write one question at a time, using little memory')
+    parser.add_option('--ndjson', action='store_true', default=False,
+                      help='write one JSON record per line (implies --stream)')
+    parser.add_option('--salt-file', metavar='PATH',
+                      help='secret key for anonymized usernames, created if missing [default: DBFILE.salt]')
+    parser.add_option('--delta', action='store_true', default=False,
+                      help='only export questions added or changed since the last export, to DBFILE.delta.json')
+    parser.add_option('--since', metavar='YYYY-MM-DD',
+                      help='only export questions added on or after this date')
+    parser.add_option('-z', '--gzip', action='store_true', dest='compress',
+                      default=False, help='write gzip-compressed output')
+    options, args = parser.parse_args()
+    if args: # old usage: DBFILE as argument
+        options.dbfile = args[0]
+    for course, dbfile in coursedb.course_dbfiles(parser, options):
+        export_orct_data(dbfile, anonymize=options.anonymize,
+                         stream=options.stream, ndjson=options.ndjson,
+                         compress=options.compress, delta=options.delta,
+                         since=options.since, saltFile=options.salt_file)
+
 if __name__ == '__main__':
-    import sys
-    export_orct_data(*sys.argv[1:])
+    main()
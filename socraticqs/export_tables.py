@@ -0,0 +1,244 @@
+try:
+    import numpy
+except ImportError: # only needed for .npz output
+    numpy = None
+import csv
+import os
+import time
+import coursedb
+import export_json
+
+_tables = ('questions', 'responses', 'error_models', 'student_errors',
+           'students')
+# personally identifying columns, never exported
+_piiColumns = {'students': ('fullname', 'username')}
+# columns holding student UIDs, replaced by pseudonyms when anonymizing
+# (0 is kept, since it marks an instructor-supplied correct answer)
+_uidColumns = {
+    'students': ('uid',),
+    'responses': ('uid', 'cluster_id', 'switched_id', 'final_id',
+                  'critique_id'),
+    'student_errors': ('uid',),
+}
+
+def table_columns(c, table):
+    'list of exportable column names of table'
+    c.execute('pragma table_info(%s)' % table)
+    return [t[1] for t in c.fetchall()
+            if t[1] not in _piiColumns.get(table, ())]
+
+def iter_batches(c, table, columns, codes=None, batchSize=10000):
+    '''generate lists of rows of table via fetchmany(), with UIDs
+    replaced by codes.code(uid) if codes is given'''
+    c.execute('select %s from %s order by rowid' % (','.join(columns), table))
+    uidIndexes = ()
+    if codes:
+        uidIndexes = [i for i, name in enumerate(columns)
+                      if name in _uidColumns.get(table, ())]
+    while True:
+        rows = c.fetchmany(batchSize)
+        if not rows:
+            break
+        if uidIndexes:
+            for j, row in enumerate(rows):
+                row = list(row)
+                for i in uidIndexes:
+                    if row[i]: # keep NULL and 0
+                        row[i] = codes.code(row[i])
+                rows[j] = row
+        yield rows
+
+def column_array(values, unsigned=False):
+    '''typed array for a list of column values, and boolean array marking
+    NULLs (or None if there are none).  The type is inferred from the
+    values themselves, since sqlite column types are only advisory;
+    unsigned forces integers to uint64 (e.g. for 64-bit pseudonyms).'''
+    isnull = [v is None for v in values]
+    types = set([type(v) for v in values if v is not None])
+    if types and types <= set((int, long)):
+        values = [v or 0 for v in values]
+        if unsigned or max(values) >= 1 << 63:
+            a = numpy.array(values, dtype='u8')
+        else:
+            a = numpy.array(values, dtype='i8')
+    elif types and types <= set((int, long, float)):
+        a = numpy.array([numpy.nan if v is None else v for v in values],
+                        dtype='f8')
+    else:
+        a = numpy.array([u'' if v is None else unicode(v) for v in values],
+                        dtype=unicode)
+    if any(isnull):
+        return a, numpy.array(isnull)
+    return a, None
+
+_kindDtypes = dict(i='i8', u='u8', f='f8', U=unicode)
+
+def concatenate_columns(batches, unsigned=False):
+    '''concatenate the (array, isnull) pairs returned by column_array()
+    for successive batches of one column, promoting them to the type
+    column_array() would have inferred from all the values at once.
+    (If a column mixes text with both integers and floats, integers
+    that shared a batch with floats are written as floats, e.g. 1.0.)'''
+    if not batches:
+        return column_array([], unsigned)
+    kinds = set([a.dtype.kind for a, isnull in batches
+                 if isnull is None or not isnull.all()]) # all-NULL: any type
+    for kind in ('U', 'f', 'u', 'i'): # widest first
+        if kind in kinds or not kinds:
+            break
+    dtype = _kindDtypes[kind]
+    arrays = []
+    nulls = []
+    for a, isnull in batches:
+        if isnull is None:
+            isnull = numpy.zeros(len(a), dtype=bool)
+        if a.dtype.kind != kind:
+            if isnull.all():
+                a = numpy.zeros(len(a), dtype=dtype)
+            elif kind == 'U': # same text as column_array() would give
+                a = numpy.array([u'' if null else unicode(v) for v, null
+                                 in zip(a.tolist(), isnull.tolist())],
+                                dtype=unicode)
+            else:
+                a = a.astype(dtype)
+            if kind == 'f':
+                a[isnull] = numpy.nan
+        arrays.append(a)
+        nulls.append(isnull)
+    isnull = numpy.concatenate(nulls)
+    if isnull.any():
+        return numpy.concatenate(arrays), isnull
+    return numpy.concatenate(arrays), None
+
+class CSVChunkWriter(object):
+    'write rows to a series of CSV files of at most chunkRows rows each'
+    def __init__(self, prefix, columns, chunkRows=100000):
+        self.prefix = prefix
+        self.columns = columns
+        self.chunkRows = chunkRows
+        self.nfile = self.nrow = 0
+        self.ofile = None
+
+    def write_rows(self, rows):
+        for row in rows:
+            if self.ofile is None or self.nrow >= self.chunkRows:
+                self.close()
+                self.ofile = open('%s.%05d.csv' % (self.prefix, self.nfile),
+                                  'wb')
+                self.writer = csv.writer(self.ofile)
+                self.writer.writerow(self.columns)
+                self.nfile += 1
+                self.nrow = 0
+            self.writer.writerow([_csv_value(v) for v in row])
+            self.nrow += 1
+
+    def close(self):
+        if self.ofile:
+            self.ofile.close()
+            self.ofile = None
+
+def _csv_value(v):
+    if v is None:
+        return ''
+    elif isinstance(v, unicode):
+        return v.encode('utf-8')
+    return v
+
+def export_table(c, table, outdir, npz=True, csvChunkRows=100000,
+                 codes=None, batchSize=10000):
+    '''write table as outdir/TABLE.npz (one typed array per column, plus
+    COLUMN.isnull for columns with NULLs) and/or chunked CSV files
+    outdir/TABLE.00000.csv etc. (if csvChunkRows); returns row count.
+    Each batch of rows is converted to typed arrays as it arrives, so
+    memory use is about that of the arrays themselves.'''
+    columns = table_columns(c, table)
+    uidColumns = ()
+    if codes:
+        uidColumns = _uidColumns.get(table, ())
+    batches = [[] for name in columns] # (array, isnull) for each batch
+    writer = None
+    if csvChunkRows:
+        writer = CSVChunkWriter(os.path.join(outdir, table), columns,
+                                csvChunkRows)
+    n = 0
+    try:
+        for rows in iter_batches(c, table, columns, codes, batchSize):
+            n += len(rows)
+            if writer:
+                writer.write_rows(rows)
+            if npz:
+                for i, column in enumerate(zip(*rows)):
+                    batches[i].append(column_array(column,
+                                                   columns[i] in uidColumns))
+    finally:
+        if writer:
+            writer.close()
+    if npz:
+        arrays = {}
+        for name, l in zip(columns, batches):
+            arrays[name], isnull = concatenate_columns(l, name in uidColumns)
+            del l[:] # free each column's batches once concatenated
+            if isnull is not None:
+                arrays[name + '.isnull'] = isnull
+        numpy.savez_compressed(os.path.join(outdir, table + '.npz'),
+                               **arrays)
+    return n
+
+def export_tables(dbfile='course.db', outdir=None, npz=True,
+                  csvChunkRows=100000, anonymize=True, saltFile=None,
+                  batchSize=10000):
+    '''export each table of dbfile (minus PII) as columnar files to
+    outdir (default: DBFILE.tables).  Student UIDs are replaced by the
+    same pseudonyms as export_json uses, unless anonymize is False.'''
+    if outdir is None:
+        outdir = dbfile + '.tables'
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    codes = None
+    if anonymize:
+        if saltFile is None:
+            saltFile = dbfile + '.salt'
+        codes = coursedb.StudentCodes(export_json.read_salt(saltFile))
+    dbconn = coursedb.DBConnection(dbfile)
+    try:
+        for table in _tables:
+            t = time.time()
+            n = export_table(dbconn.c, table, outdir, npz, csvChunkRows,
+                             codes, batchSize)
+            export_json.print_timing('%s: %d rows' % (table, n), t)
+    finally:
+        dbconn.close()
+
+def main():
+    'export tables of one course database, or every course in --dbdir'
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] [DBFILE]')
+    coursedb.add_course_options(parser)
+    parser.add_option('-o', '--outdir',
+                      help='output directory [default: DBFILE.tables]')
+    parser.add_option('--no-npz', action='store_false', dest='npz',
+                      default=True, help='do not write NumPy .npz files')
+    parser.add_option('--csv-rows', type='int', default=100000,
+                      help='rows per CSV file, or 0 for no CSV [default: %default]')
+    parser.add_option('--batch-size', type='int', default=10000,
+                      help='rows fetched from the database at a time [default: %default]')
+    parser.add_option('--no-anonymize', action='store_false',
+                      dest='anonymize', default=True,
+                      help='keep student UIDs in the output')
+    parser.add_option('--salt-file', metavar='PATH',
+                      help='secret key for anonymized UIDs [default: DBFILE.salt]')
+    options, args = parser.parse_args()
+    if args:
+        options.dbfile = args[0]
+    if options.npz and numpy is None:
+        parser.error('writing .npz files requires numpy; use --no-npz')
+    for course, dbfile in coursedb.course_dbfiles(parser, options):
+        outdir = options.outdir
+        if outdir and course: # one subdirectory per course
+            outdir = os.path.join(outdir, course)
+        export_tables(dbfile, outdir, options.npz, options.csv_rows,
+                      options.anonymize, options.salt_file,
+                      options.batch_size)
+
+if __name__ == '__main__':
+    main()
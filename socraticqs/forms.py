@@ -5,8 +5,8 @@ def login_form(action='login',
                registerText='''<br>
                If you have never logged in, click here to
                <A HREF="register_form">register</A>.
-               '''):
-    doc = webui.Document('Login')
+               ''', header=None):
+    doc = webui.Document('Login', header)
     doc.add_text(text)
     form = webui.Form(action)
     form.append(webui.Data('username:'))
@@ -23,8 +23,8 @@ def register_form(action='register',
                   loginText='''<br>
                   If you have already registered, click here to
                   <A HREF="login_form">login</A>.
-                  '''):
-    doc = webui.Document('Register')
+                  ''', header=None):
+    doc = webui.Document('Register', header)
     doc.add_text(text)
     form = webui.Form(action)
     form.append(webui.Data('username:'))
@@ -44,9 +44,10 @@ def add_confidence_choice(form, levels=('Just guessing', 'Not quite sure',
     form.append('<br>\nHow confident are you in your answer?<br>\n')
     form.append(webui.RadioSelection('confidence', list(enumerate(levels))))
     
-def build_reconsider_form(qid, bottom='', title='Reconsidering your answer'):
+def build_reconsider_form(qid, bottom='', title='Reconsidering your answer',
+                          header=None):
     'return HTML for standard form for round 2'
-    doc = webui.Document(title)
+    doc = webui.Document(title, header)
     doc.add_text('''<B>Instructions</B>: As soon as your partner is
     ready, please take turns explaining why you think your
     answer is right, approximately one minute each.
@@ -69,7 +70,7 @@ def build_reconsider_form(qid, bottom='', title='Reconsidering your answer'):
 
 def build_assess_form(q, errorModels=(), bottom='', title='Assessing your answer'):
     'return HTML for standard form for round 2'
-    doc = webui.Document(title)
+    doc = webui.Document(title, getattr(q, 'pageHeader', None))
     if getattr(q, 'showAnswer', False) and getattr(q, 'explanation', False):
         doc.add_text('Answer: ' + q.explanation, 'B')
         doc.add_text('<HR>\n')
@@ -108,8 +109,9 @@ def build_quizmode_form(formtitle='Switch to Quiz Mode?',
                         questions. You must answer all questions.
                         When you have answered all questions, click Go
                         to submit your answers.  Note that your submitted
-                        answers are final; you cannot resubmit answers again.'''):
-    doc = webui.Document(formtitle)
+                        answers are final; you cannot resubmit answers again.''',
+                        header=None):
+    doc = webui.Document(formtitle, header)
     doc.add_text(explanation)
     form = webui.Form('quizmode')
     form.append('<br>\nQuiz Title:\n')
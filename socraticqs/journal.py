@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import Queue
+
+def serializable_args(kwargs):
+    'copy of form kwargs restricted to values we can write to the journal'
+    d = {}
+    for k,v in kwargs.items():
+        if isinstance(v, (basestring, int, long, float)):
+            d[k] = v
+        elif isinstance(v, (list, tuple)) \
+             and all([isinstance(x, basestring) for x in v]):
+            d[k] = list(v)
+        # uploaded files etc. are not journaled
+    return d
+
+def file_hash(path):
+    'SHA-1 hex digest of the contents of file path, or None if no file'
+    if not path or not os.path.exists(path):
+        return None
+    h = hashlib.sha1()
+    ifile = open(path, 'rb')
+    try:
+        for block in iter(lambda:ifile.read(65536), ''):
+            h.update(block)
+    finally:
+        ifile.close()
+    return h.hexdigest()
+
+def read_journal(path):
+    'return list of records saved in journal file, or [] if none'
+    if not os.path.exists(path):
+        return []
+    records = []
+    ifile = open(path, 'rb')
+    try:
+        for line in ifile:
+            try:
+                records.append(json.loads(line))
+            except ValueError: # last line truncated by a crash
+                break
+    finally:
+        ifile.close()
+    return records
+
+class Journal(object):
+    '''append-only log of every change to live question state.
+    append() just queues a record; a background thread writes queued
+    records to the file in batches (one fsync per batch), and
+    periodically calls checkpoint() to save responses to the database.'''
+    def __init__(self, path, checkpoint=None, interval=30.):
+        self.path = path
+        self.checkpoint = checkpoint
+        self.interval = interval
+        self.queue = Queue.Queue() # thread-safe container
+        self.ofile = open(path, 'ab')
+        self.thread = threading.Thread(target=self._writer)
+        self.thread.daemon = True # don't block interpreter exit
+        self.thread.start()
+
+    def append(self, kind, **kwargs):
+        'queue a record for writing; never waits for the disk'
+        kwargs['kind'] = kind
+        kwargs.setdefault('time', time.time())
+        self.queue.put(kwargs)
+
+    def _writer(self):
+        lastCheckpoint = time.time()
+        running = True
+        while running:
+            wait = max(0., lastCheckpoint + self.interval - time.time())
+            try:
+                records = [self.queue.get(timeout=wait)]
+            except Queue.Empty:
+                records = []
+            while True: # drain everything queued so far into one batch
+                try:
+                    records.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if None in records: # close() was called
+                records = records[:records.index(None)]
+                running = False
+            if records:
+                for record in records:
+                    self.ofile.write(json.dumps(record) + '\n')
+                self.ofile.flush()
+                os.fsync(self.ofile.fileno())
+            if self.checkpoint and running \
+               and time.time() >= lastCheckpoint + self.interval:
+                try:
+                    self.checkpoint()
+                except Exception, e: # keep journaling even if db fails
+                    print 'ERROR: checkpoint failed:', e
+                lastCheckpoint = time.time()
+
+    def close(self, remove=False):
+        'write any queued records and stop the writer thread'
+        self.queue.put(None)
+        self.thread.join()
+        self.ofile.close()
+        if remove: # everything has been saved to the database
+            os.remove(self.path)
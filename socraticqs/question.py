@@ -1,7 +1,11 @@
 import os.path
 import time
+import threading
+from collections import OrderedDict
+from itertools import islice
 import webui
 import forms
+import textcluster
 import subprocess
 
 letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
@@ -15,22 +19,103 @@ def missing_params(*args):
         if arg is None:
             return True
 
+def add_count(d, k, n=1):
+    'add n to count d[k], deleting it once it reaches zero'
+    n += d.get(k, 0)
+    if n:
+        d[k] = n
+    else:
+        del d[k]
+
+def index_response(d, k, r, n=1):
+    'add response r to (or if n=-1, remove it from) index d[k]'
+    if n > 0:
+        d.setdefault(k, {})[id(r)] = r
+    else:
+        l = d[k]
+        del l[id(r)]
+        if not l:
+            del d[k]
+
+def sort_by_uid(d):
+    'list the responses of index entry d in student order'
+    l = d.values()
+    l.sort(key=lambda r: r.uid)
+    return l
+
+def tally_key(r):
+    '''key for counting response r by category: responses compare
+    equal iff their hashes are equal (see __cmp__() and __hash__() below),
+    and unlike r itself, the key does not change later'''
+    if r is None:
+        return None
+    return hash(r)
+
+_elapsedTag = '<!--elapsed-->' # replaced by time since start on every view
+
+def cached_page(method):
+    '''cache the HTML returned by an instructor page method, keyed by its
+    arguments, the question's stateVersion and the number of logins,
+    so auto-refreshes with no new submissions just reuse it'''
+    def page(self, *args, **kwargs):
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        with self.lock: # don't render while a submission changes state
+            try:
+                version, s = self._pageCache[key]
+            except KeyError:
+                version = None
+            if version != (self.stateVersion, len(self.courseDB.logins)):
+                s = method(self, *args, **kwargs)
+                self._pageCache[key] = ((self.stateVersion,
+                                         len(self.courseDB.logins)), s)
+        return self.fill_elapsed(s)
+    page.__name__ = method.__name__
+    page.__doc__ = method.__doc__
+    return page
+
+def locked(method):
+    '''run method holding its question's lock, since the web server
+    calls questions from many threads at once'''
+    def run(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    run.__name__ = method.__name__
+    run.__doc__ = method.__doc__
+    return run
+
 
 
 class Response(object):
-    'subclass this to supply different storage and representation methods'
+    '''subclass this to supply different storage and representation methods.
+    Uses __slots__ to keep per-response memory small; optional fields
+    (set by later stages) stay unset until then, so hasattr() and
+    getattr(r, attr, None) work as usual.'''
+    __slots__ = ('uid', 'question', 'timestamp', 'confidence',
+                 'version', 'savedVersion', 'id', # database bookkeeping
+                 'savedErrorIDs',
+                 'prototype', 'response2', 'confidence2', 'reasons',
+                 'errorIDs', 'critiqueTarget', 'criticisms',
+                 'finalVote', 'finalConfidence')
     def __init__(self, uid, question, confidence, *args, **kwargs):
         self.uid = uid
         self.question = question
         self.timestamp = time.time()
         self.confidence = int(confidence)
+        self.version = 1 # not yet saved
+        self.savedVersion = 0 # version last written to the database
         self.save_data(*args, **kwargs)
 
     def save_data(self, **kwargs):
         for attr, val in kwargs.items():
             setattr(self, attr, val)
 
+    def touch(self):
+        'mark this response as changed since it was last saved'
+        self.version += 1
+        self.question.changed()
+
 class MultiChoiceResponse(Response):
+    __slots__ = ('choice',)
     def save_data(self, choice):
         self.choice = int(choice)
     def get_answer(self):
@@ -51,6 +136,7 @@ class MultiChoiceResponse(Response):
 
 class ClusteredResponse(Response):
     'a pair matches if they have the same prototype'
+    __slots__ = ()
     def __cmp__(self, other):
         try:
             return cmp(id(self.prototype), id(other.prototype))
@@ -63,6 +149,7 @@ class ClusteredResponse(Response):
             return id(self)
 
 class TextResponse(ClusteredResponse):
+    __slots__ = ('text',)
     def save_data(self, text):
         self.text = text
     def get_answer(self):
@@ -71,6 +158,7 @@ class TextResponse(ClusteredResponse):
         return self.text + '<br>\n'
 
 class ImageResponse(ClusteredResponse):
+    __slots__ = ('path', 'text', 'imageDir', 'hideMe')
     def save_data(self, path, text, imageDir, hideMe=False):
         self.path = path
         self.text = text
@@ -87,13 +175,17 @@ class ImageResponse(ClusteredResponse):
         if self.hideMe:
             s += self.hideMe + '<br>\n'
         elif self.path:
-            s += '<IMG SRC="/images/%s"><br>\n' % self.path
+            s += '<IMG SRC="%s/images/%s"><br>\n' \
+                 % (self.question.rootPath, self.path)
         if self.text:
             s += self.text + '<br>\n'
         return s
 
 class QuestionBase(object):
     def __init__(self, questionID, title, text, explanation, nerror, *args, **kwargs):
+        self.lock = threading.RLock() # guards state shared by server threads
+        self.stateVersion = 0 # bumped by changed() on every submission
+        self._pageCache = {} # see cached_page()
         self.id = questionID
         self.title = title
         self.text = text
@@ -106,12 +198,22 @@ class QuestionBase(object):
             del kwargs['rootPath']
         except KeyError:
             self.rootPath = ''
+        self.pageHeader = kwargs.pop('pageHeader', None) # e.g. MathJax script
         self.refresh = 15
         self.categories = {}
         for attr in ('hasReasons', 'isClustered', 'noMatch', 'hasFinalVote',
                      'hasCritique'):
             setattr(self, attr, set()) # initialize answer counters
-        doc = webui.Document(title)
+        self.confidenceCounts = {} # tallies maintained by tally()
+        self.reasonsCounts = {}
+        self.roundCounts = ({}, {}, {}) # see count_rounds()
+        self.categoryReasons = {} # {tally_key(category):{id(r):r}}
+        self.critiques = {} # {tally_key(critiqueTarget):{id(r):r}}
+        self._referrers = {} # {id(target):{id(r):r}}, see tally()
+        self.unclustered = OrderedDict() # {uid:r} in order of arrival
+        self.unclusteredGroups = OrderedDict() # {duplicate_group(r):{uid:r}}
+        self._unclusteredGroupOf = {} # {uid:duplicate_group(r)}
+        doc = webui.Document(title, self.pageHeader)
         self.doc = doc
         doc.add_text(text)
         form = webui.Form('submit')
@@ -129,11 +231,15 @@ class QuestionBase(object):
         for attr in self._stages: # initialize submission action dict
             d[attr] = getattr(self, attr)
         self.submitStages = d
+        self.adminStages = dict([(attr, getattr(self, attr))
+                                 for attr in self._adminStages
+                                 if hasattr(self, attr)])
         self._afterURL = self.get_url('assess')
         self._viewHTML = {
             'answer': str(doc),
             'reconsider': forms.build_reconsider_form(questionID,
-                                                      self._navHTML),
+                                                      self._navHTML,
+                                                      header=self.pageHeader),
             'assess': '''Your instructor has not yet started the ASSESS phase.
             When your instructor asks you to, please click here to
             <A HREF="%s">ASSESS</A> your answer.%s''' \
@@ -157,11 +263,114 @@ class QuestionBase(object):
 
 
     _stages = ('answer', 'reconsider', 'assess')
+    # instructor actions that change question state, logged as events
+    _adminStages = ('start_timer', 'show_answer', 'add_categories',
+                    'correct', 'add_correct', 'init_vote')
     _afterText = 'assess your answer'
 
     def __str__(self):
         return str(self.doc)
 
+    @locked
+    def changed(self):
+        'record a change of question state, invalidating cached pages'
+        self.stateVersion += 1
+
+    @locked
+    def tally(self, r, n=1):
+        '''add response r to (or if n=-1, remove it from) the confidence,
+        reasons and round tallies and the reasons and critiques indexes,
+        and index it as a referrer of its response2, finalVote and
+        critiqueTarget'''
+        add_count(self.confidenceCounts, r.confidence, n)
+        try:
+            add_count(self.reasonsCounts, r.reasons, n)
+        except AttributeError:
+            pass
+        if getattr(r, 'reasons', None):
+            index_response(self.categoryReasons, tally_key(r), r, n)
+        critiqueTarget = getattr(r, 'critiqueTarget', None)
+        if critiqueTarget is not None and getattr(r, 'criticisms', None):
+            index_response(self.critiques, tally_key(critiqueTarget), r, n)
+        targets = (getattr(r, 'response2', None),
+                   getattr(r, 'finalVote', None))
+        for d, target in zip(self.roundCounts, (r,) + targets):
+            add_count(d, tally_key(target), n)
+        for target in targets + (critiqueTarget,):
+            if target is None:
+                continue
+            refs = self._referrers.setdefault(id(target), {})
+            if n > 0:
+                refs[id(r)] = r
+            else:
+                refs.pop(id(r), None)
+                if not refs:
+                    del self._referrers[id(target)]
+
+    @locked
+    def add_response(self, response):
+        'store a new response, replacing any previous one from the student'
+        try:
+            self.tally(self.responses[response.uid], -1)
+        except KeyError:
+            pass
+        if response.uid in self.unclustered:
+            self.remove_unclustered(response.uid)
+        self.responses[response.uid] = response
+        if not hasattr(response, 'prototype'):
+            self.unclustered[response.uid] = response
+            k = self._unclusteredGroupOf[response.uid] = \
+                self.duplicate_group(response)
+            self.unclusteredGroups.setdefault(k, OrderedDict())[response.uid] \
+                = response
+        self.tally(response)
+        self.changed()
+
+    def remove_unclustered(self, uid):
+        'remove a response from the uncategorized pool'
+        del self.unclustered[uid]
+        k = self._unclusteredGroupOf.pop(uid)
+        group = self.unclusteredGroups[k]
+        del group[uid]
+        if not group:
+            del self.unclusteredGroups[k]
+
+    def duplicate_group(self, response):
+        '''key shared by near-duplicate responses; by default each
+        response is only a duplicate of itself'''
+        return response.uid
+
+    def near_duplicates(self, response):
+        'list of other uncategorized responses near-duplicating response'
+        try:
+            group = self.unclusteredGroups[self._unclusteredGroupOf[response.uid]]
+        except KeyError:
+            return []
+        return [r for r in group.itervalues() if r is not response]
+
+    @locked
+    def update_response(self, response, **kwargs):
+        '''set attributes of response, keeping the tallies up to date.
+        Changing its prototype changes which category it counts as,
+        so responses referring to it are re-tallied too.'''
+        l = [response]
+        if 'prototype' in kwargs:
+            l += [r for r in self._referrers.get(id(response), {}).values()
+                  if r is not response]
+        for r in l:
+            self.tally(r, -1)
+        for attr, val in kwargs.items():
+            setattr(response, attr, val)
+        for r in l:
+            self.tally(r)
+
+    def fill_elapsed(self, s):
+        'substitute time since start into page s'
+        if _elapsedTag not in s:
+            return s
+        elapsed = int(time.time() - self.starttime)
+        return s.replace(_elapsedTag, '%d:%02d' % (elapsed / 60, elapsed % 60))
+
     # status reporting functions
     def answer_monitor(self, monitor):
         if monitor:
@@ -174,6 +383,11 @@ class QuestionBase(object):
                                len(self.responses)))
 
     # student interfaces
+    def replay_args(self, uid, stage):
+        '''extra arguments to log for a submission that replaying needs
+        but the form data lacks, e.g. the name of a stored upload'''
+        return {}
+
     def get_url(self, stage, action='view'):
         return '%s?qid=%d&stage=%s' % (action, self.id, stage)
 
@@ -207,15 +421,17 @@ class QuestionBase(object):
                 does not exist.  Please click your browser's back button
                 to re-enter it!""" + self._navHTML
             try:
-                response.response2 = self.responses[partnerUID]
+                response2 = self.responses[partnerUID]
             except KeyError:
                 return """Sorry, that username does not appear to
                 have entered an answer!  Tell them to enter their answer, then
                 click your browser's back button to resubmit your form.""" \
                 + self._navHTML
         else:
-            response.response2 = response
-        response.confidence2 = int(confidence)
+            response2 = response
+        self.update_response(response, response2=response2,
+                             confidence2=int(confidence))
+        response.touch()
         self.hasReasons.add(uid)
         if monitor:
             monitor.message('recons: %d of %d total'
@@ -229,39 +445,59 @@ class QuestionBase(object):
             response = self.responses[uid]
         except KeyError:
             return self._noResponseHTML
-        response.reasons = assessment
-        response.errorIDs = [self.errorIDs[int(e)] for e in errors]
+        self.update_response(response, reasons=assessment,
+                             errorIDs=[self.errorIDs[int(e)] for e in errors])
+        response.touch()
         if assessment == 'correct': # categorize as right answer
             self.set_prototype(response, self.correctAnswer)
         else:
-            response.critiqueTarget = response
-            response.criticisms = differences
+            self.update_response(response, critiqueTarget=response,
+                                 criticisms=differences)
             self.noMatch.add(uid)
         self.cluster_monitor(monitor)
         return '''Thanks! When your instructor asks you to, please click here to
         <A HREF="index">continue</A>.\n%s''' % self._navHTML
 
-    def cluster_form(self, uid):
+    maxMatches = 5 # closest categories shown in a student's cluster form
+
+    def cluster_form(self, uid, showAll=''):
         try:
             response = self.responses[uid]
         except KeyError:
             return self._noResponseHTML
         if response in self.categories:
             return self._matchedHTML
-        else:
+        try:
+            categories, rankings = self._clusterRankings
+            ranking = rankings[uid]
+        except (AttributeError, KeyError):
             return self._clusterFormHTML
-
-    def build_cluster_form(self, title='Cluster Your Answer'):
-        doc = webui.Document(title)
-        doc.add_text('''Either choose the answer that basically matches
-        your original answer, or choose <B>None of the Above</B><br>
-        ''')
+        if showAll or categories is not self.categoriesSorted: # stale
+            return self._clusterFormHTML
+        return self.build_cluster_form(ranking=ranking[:self.maxMatches])
+
+    def build_cluster_form(self, title='Cluster Your Answer', ranking=None):
+        '''form for choosing a category; if ranking (a list of indexes
+        into categoriesSorted) is given, show only those categories'''
+        doc = webui.Document(title, self.pageHeader)
+        if ranking is None:
+            doc.add_text('''Either choose the answer that basically matches
+            your original answer, or choose <B>None of the Above</B><br>
+            ''')
+        else:
+            doc.add_text('''These are the answers closest to your original
+            answer.  Either choose the one that basically matches it,
+            or if none of them do, click here to
+            <A HREF="%s&showAll=1">show all answers</A>.<br>
+            ''' % self.get_url('cluster'))
         form = webui.Form('submit')
         form.append(webui.Input('qid', 'hidden', str(self.id)))
         form.append(webui.Input('stage', 'hidden', 'cluster'))
         l = []
         for i,r in enumerate(self.list_categories()):
             l.append((i, str(r)))
+        if ranking is not None:
+            l = [l[i] for i in ranking]
         l.append(('none', 'None of the above'))
         form.append(webui.RadioSelection('match', l))
         form.append('<br>\n')
@@ -269,11 +505,18 @@ class QuestionBase(object):
         doc.add_text(self._navHTML)
         return str(doc)
 
+    def rank_categories(self):
+        '''{uid:[index into categoriesSorted, ...]} ranking categories
+        by similarity to each uncategorized response, best first;
+        none by default'''
+        return {}
+
     def cluster(self, uid, match=None, monitor=None):
         if missing_params(match):
             return _missing_arg_msg
         if match == 'none':
             self.noMatch.add(uid)
+            self.changed()
             self.cluster_monitor(monitor)
             return '''OK.  Hopefully we can cluster your answer in the next
             round.  When your instructor asks you to, please click here to
@@ -299,7 +542,7 @@ class QuestionBase(object):
                         text='''<h1>Vote</h1>
                         Which of the following answers do you think is correct?
                         <br>'''):
-        doc = webui.Document(title)
+        doc = webui.Document(title, self.pageHeader)
         doc.add_text(text)
         if form is None:
             form = self.get_choice_form()
@@ -356,8 +599,9 @@ class QuestionBase(object):
         except (AttributeError,IndexError,ValueError):
             return 'Please go back and resubmit your vote when your instructor says to.' \
                    + self._navHTML
-        response.finalVote = category
-        response.finalConfidence = int(confidence)
+        self.update_response(response, finalVote=category,
+                             finalConfidence=int(confidence))
+        response.touch()
         self.hasFinalVote.add(uid)
         if monitor:
             monitor.message('voted: %d of %d total'
@@ -392,7 +636,7 @@ class QuestionBase(object):
                                  Briefly state what you think was wrong with your original answer:
                                  <br>''',
                                  action='self_critique'):
-        doc = webui.Document(title)
+        doc = webui.Document(title, self.pageHeader)
         doc.add_text(text)
         form = webui.Form('submit')
         form.append(webui.Input('qid', 'hidden', str(self.id)))
@@ -413,8 +657,9 @@ class QuestionBase(object):
             return self._noResponseHTML
         if category is None: # treat this as a self-critique
             category = response
-        response.critiqueTarget = category
-        response.criticisms = criticisms
+        self.update_response(response, critiqueTarget=category,
+                             criticisms=criticisms)
+        response.touch()
         self.hasCritique.add(uid)
         if monitor:
             monitor.message('critique: %d of %d total'
@@ -424,17 +669,16 @@ class QuestionBase(object):
         <A HREF="index">continue</A>.\n%s''' % self._navHTML
 
     # instructor interfaces
+    @cached_page
     def start_admin(self, starttimer=0, showresp=''):
-        doc = webui.Document('Socraticqs Admin')
+        doc = webui.Document('Socraticqs Admin', self.pageHeader)
         doc.add_text(self.title, 'H1')
         doc.add_text(self.text, 'BIG')
         doc.add_text('<HR>\n')
-        if starttimer: # start the timer
-            self.starttime = time.time()
+        if starttimer:
+            self.start_timer()
         if hasattr(self, 'starttime'): # show timer, progress stats
-            elapsed = int(time.time() - self.starttime)
-            doc.add_text('Time since start: %d:%02d'
-                         % (elapsed / 60, elapsed % 60))
+            doc.add_text('Time since start: ' + _elapsedTag)
             doc.add_text(' (updates every %d sec)' % self.refresh)
             doc.add_text('<BR>\n')
             t = webui.Table('Student Answers So Far',
@@ -445,11 +689,10 @@ class QuestionBase(object):
                 doc.add_text('<BR>\n(<A HREF="qadmin">hide answers</A>)<BR>\n')
             else:
                 doc.add_text('<BR>\n(<A HREF="qadmin?showresp=1">show answers</A>)<BR>\n')
-            counts = [0, 0, 0]
-            for r in self.responses.values():
-                if showresp:
+            if showresp:
+                for r in self.responses.values():
                     doc.add_text(str(r), 'LI')
-                counts[r.confidence] += 1
+            counts = [self.confidenceCounts.get(i, 0) for i in range(3)]
             counts.append(len(self.courseDB.logins) - len(self.responses))
             t.append(counts)
             doc.add_text('''<BR><B>Instructions</B>: when you feel
@@ -476,12 +719,23 @@ class QuestionBase(object):
         doc.add_text(self.server.admin_nav())
         return str(doc)
 
-    def assess_admin(self, showresp=''):
+    def start_timer(self):
+        'start timing student answers'
+        self.starttime = time.time()
+        self.changed()
+
+    def show_answer(self):
+        'show the answer and explanation on the students\' ASSESS form'
         if not getattr(self, 'showAnswer', False):
             self.showAnswer = True
             self._viewHTML['assess'] = \
                 forms.build_assess_form(self, self.errorModels, self._navHTML)
-        doc = webui.Document('Socraticqs Admin')
+            self.changed()
+
+    @cached_page
+    def assess_admin(self, showresp=''):
+        self.show_answer()
+        doc = webui.Document('Socraticqs Admin', self.pageHeader)
         doc.add_text(self.title + ' Answer', 'H1')
         if hasattr(self, 'correctAnswer'):
             doc.add_text(str(self.correctAnswer), 'BIG')
@@ -489,9 +743,7 @@ class QuestionBase(object):
         doc.add_text(self.explanation, 'B')
         doc.add_text('<HR>\n')
         if hasattr(self, 'starttime'): # show timer, progress stats
-            elapsed = int(time.time() - self.starttime)
-            doc.add_text('Time since start: %d:%02d'
-                         % (elapsed / 60, elapsed % 60))
+            doc.add_text('Time since start: ' + _elapsedTag)
             doc.add_text(' (updates every %d sec)' % self.refresh)
             doc.add_text('<BR>\n')
             t = webui.Table('Self-Assessments So Far',
@@ -502,14 +754,11 @@ class QuestionBase(object):
                 doc.add_text('<BR>\n(<A HREF="qassess">hide self-assessments</A>)<BR>\n')
             else:
                 doc.add_text('<BR>\n(<A HREF="qassess?showresp=1">show self-assessments</A>)<BR>\n')
-            counts = {}
-            for r in self.responses.values():
-                if showresp and getattr(r, 'criticisms', False):
-                    doc.add_text(r.criticisms, 'LI')
-                try:
-                    counts[r.reasons] = counts.get(r.reasons, 0) + 1
-                except AttributeError:
-                    pass
+            if showresp:
+                for r in self.responses.values():
+                    if getattr(r, 'criticisms', False):
+                        doc.add_text(r.criticisms, 'LI')
+            counts = self.reasonsCounts
             t.append((counts.get('different', 0), counts.get('close', 0),
                       counts.get('correct', 0),
                       len(self.responses) - sum(counts.values())))
@@ -523,13 +772,14 @@ class QuestionBase(object):
         doc.add_text(self.server.admin_nav())
         return str(doc)
 
+    @cached_page
     def prototype_form(self, offset=0, maxview=None,
                        title='Categorize Responses'):
         offset = int(offset)
         unclustered = self.count_unclustered()
         if unclustered == 0:
             return self.cluster_report()
-        doc = webui.Document(title)
+        doc = webui.Document(title, self.pageHeader)
         doc.add_text('''<B>Instructions</B>: if you wish, you can choose
         individual responses as distinct categories of answers, and
         then ask the students to assign themselves to these categories.
@@ -543,28 +793,54 @@ class QuestionBase(object):
                     doc.add_text('<B>correct</B>: ' + str(r), 'LI')
                 else:
                     doc.add_text(str(r), 'LI')
-        doc.add_text('%d Uncategorized Responses' % unclustered, 'h1')
-        doc.add_text('''Choose one or more responses as new, distinct
-        categories of student answers:<br>
-        ''')
-        l = list(self.iter_unclustered())[offset:]
         if not maxview:
             try:
                 maxview = self.maxview
             except AttributeError:
                 maxview = 10
         maxview = int(maxview)
-        if maxview and len(l) > maxview:
-            l = l[:maxview]
+        suggestions = self.suggest_prototypes()
+        if suggestions:
+            doc.add_text('%d Suggested Categories' % len(suggestions), 'h1')
+            doc.add_text('''Groups of similar responses found automatically.
+            Choose <B>add</B> to make a response a new category, or
+            <B>add group</B> to also put the similar responses in it:<br>
+            ''')
+            form = webui.Form('add_prototypes')
+            for r, members in suggestions[:maxview or None]:
+                group = ''.join(['<LI>%s</LI>' % m for m in members])
+                form.append(webui.RadioSelection('resp_' + str(r.uid),
+                    (('add', str(r)),
+                     ('group', 'add group with %d similar responses:<UL>%s</UL>'
+                      % (len(members), group)))))
+                form.append(self.members_input(r, members
+                                               + self.near_duplicates(r)))
+            doc.append(form)
+        ngroups = len(self.unclusteredGroups)
+        if ngroups < unclustered: # near-duplicates are listed once
+            doc.add_text('%d Uncategorized Responses (%d distinct)'
+                         % (unclustered, ngroups), 'h1')
+        else:
+            doc.add_text('%d Uncategorized Responses' % unclustered, 'h1')
+        doc.add_text('''Choose one or more responses as new, distinct
+        categories of student answers:<br>
+        ''')
         form = webui.Form('add_prototypes')
-        for r in l:
-            form.append(webui.RadioSelection('resp_' + str(r.uid),
-                                             (('add', str(r)),)))
+        for l in self.iter_unclustered_groups(offset, maxview or None):
+            choices = [('add', str(l[0]))]
+            if len(l) > 1:
+                group = ''.join(['<LI>%s</LI>' % r for r in l[1:]])
+                choices.append(('group', 'add group with its %d near-duplicates:<UL>%s</UL>'
+                                % (len(l) - 1, group)))
+            form.append(webui.RadioSelection('resp_' + str(l[0].uid),
+                                             choices))
+            if len(l) > 1:
+                form.append(self.members_input(l[0], l[1:]))
         doc.append(form)
         if offset > 0:
             doc.add_text('<A HREF="prototype_form?offset=%d&maxview=%d">[Previous %d]</A>\n'
                          % (max(0, offset - maxview), maxview, maxview))
-        if maxview and unclustered > offset + maxview:
+        if maxview and ngroups > offset + maxview:
             doc.add_text('<A HREF="prototype_form?offset=%d&maxview=%d">[Next %d]</A>\n'
                          % (offset + maxview, maxview, maxview))
         doc.add_text('''<br>If you want to "declare victory", click here to
@@ -577,21 +853,33 @@ class QuestionBase(object):
         if self.correctAnswer not in self.categories:
             self.categories[self.correctAnswer] = []
             self.list_categories(True) # force this to update
+            self.changed()
 
     def count_unclustered(self):
-        return len(self.responses) - len(self.isClustered)
-
-    def iter_unclustered(self):
-        for r in self.responses.values():
-            if not hasattr(r, 'prototype'):
-                yield r
+        return len(self.unclustered)
+
+    def iter_unclustered(self, offset=0, limit=None):
+        'iterate over uncategorized responses in order of arrival'
+        if limit is not None:
+            limit += offset
+        return islice(self.unclustered.itervalues(), offset, limit)
+
+    def iter_unclustered_groups(self, offset=0, limit=None):
+        '''iterate over lists of uncategorized responses, one per group
+        of near-duplicates, in order of each group's arrival'''
+        if limit is not None:
+            limit += offset
+        for group in islice(self.unclusteredGroups.itervalues(), offset,
+                            limit):
+            yield group.values()
 
     _gotoVoteHTML = '''Tell the students to proceed with their vote.
     Finally, click here to <A HREF="analysis">analyze the results</A>.'''
 
+    @cached_page
     def cluster_report(self):
         fmt = '%(answer)s<br><b>(%(tag)s answer chosen by %(n)d students)</b>'
-        doc = webui.Document('Clustering Complete')
+        doc = webui.Document('Clustering Complete', self.pageHeader)
         doc.add_text('Done: %d responses in %d categories:'
                      % (len(self.responses), len(self.categories)), 'h1')
         try:
@@ -614,25 +902,70 @@ class QuestionBase(object):
 
     def correct(self, choice):
         self.correctAnswer = self.categoriesSorted[int(choice)]
+        self.touch_all()
+        self.changed()
         self.init_vote()
         return 'Great.  ' + self._gotoVoteHTML
 
+    def suggest_prototypes(self):
+        '''list of (response, [similar responses]) suggested as new
+        categories from the uncategorized responses; none by default'''
+        return []
+
     def add_prototypes(self, **kwargs):
+        'add categories chosen on prototype_form, see add_categories()'
+        n = self.add_categories(**kwargs)
+        s = '''Added %d categories.  Tell the students to categorize
+        themselves vs. your new categories.  When they are done,
+        click here to <A HREF="prototype_form">continue</A>.\n''' % n
+        s += self.server.admin_nav()
+        return s
+
+    def members_input(self, response, members):
+        'hidden field listing the group members shown for response'
+        uids = []
+        for r in members:
+            if r.uid not in uids: # suggestions may include near-duplicates
+                uids.append(r.uid)
+        return webui.Input('members_%d' % response.uid, 'hidden',
+                           ','.join(map(str, uids)))
+
+    def add_categories(self, **kwargs):
+        '''make each resp_UID=add response a new category; for
+        resp_UID=group also categorize the members_UID responses listed
+        on the form (by default, its suggested similar responses and
+        near-duplicates).  Returns the number of new categories.'''
+        suggestions = None
         n = 0
+        groups = []
         for k,v in kwargs.items():
-            if v == 'add':
+            if v in ('add', 'group'):
                 uid = int(k.split('_')[1])
                 response = self.responses[uid]
+                if v == 'group' and 'members_%d' % uid in kwargs:
+                    # exactly the group the instructor saw, even if the
+                    # suggestions have changed since
+                    groups.append((response, [self.responses[int(m)]
+                        for m in kwargs['members_%d' % uid].split(',')
+                        if m and int(m) in self.responses]))
+                elif v == 'group':
+                    if suggestions is None:
+                        suggestions = dict([(r.uid, members) for r, members
+                                            in self.suggest_prototypes()])
+                    groups.append((response, list(suggestions.get(uid, ()))
+                                   + self.near_duplicates(response)))
                 self.set_prototype(response)
                 n += 1
+        for category, members in groups: # after all new prototypes are set
+            for r in members:
+                if self.unclustered.get(r.uid) is r:
+                    self.set_prototype(r, category)
         self.list_categories(True) # force this to update
         self._clusterFormHTML = self.build_cluster_form()
+        self._clusterRankings = (self.categoriesSorted, self.rank_categories())
         self.noMatch.clear()
-        s = '''Added %d categories.  Tell the students to categorize
-        themselves vs. your new categories.  When they are done,
-        click here to <A HREF="prototype_form">continue</A>.\n''' % n
-        s += self.server.admin_nav()
-        return s
+        self.changed()
+        return n
 
     def list_categories(self, update=False):
         if not update and getattr(self, 'categoriesSorted', False):
@@ -648,9 +981,17 @@ class QuestionBase(object):
             self.categories[category] = [category]
         else:
             self.categories[category].append(response)
-        response.prototype = category
+        self.update_response(response, prototype=category)
+        if self.unclustered.get(response.uid) is response:
+            self.remove_unclustered(response.uid)
+        response.touch()
         self.isClustered.add(response.uid)
 
+    def touch_all(self):
+        'mark every response changed, e.g. because correctAnswer changed'
+        for r in self.responses.values():
+            r.touch()
+
     def is_correct(self, response):
         try:
             return response == self.correctAnswer
@@ -658,31 +999,29 @@ class QuestionBase(object):
             return None
 
     def init_vote(self):
+        old = [self._viewHTML.get(k)
+               for k in ('vote', 'critique', 'self_critique')]
         self._viewHTML['vote'] = self.build_vote_form()
         self._viewHTML['critique'] = self.build_critique_form()
         self._viewHTML['self_critique'] = self.build_self_critique_form()
+        if old != [self._viewHTML[k]
+                   for k in ('vote', 'critique', 'self_critique')]:
+            self.changed()
         
     def count_rounds(self):
-        'return vote counts for the three rounds of response'
-        d1 = {}
-        d2 = {}
-        d3 = {}
-        for r in self.responses.values():
-            d1[r] = d1.get(r, 0) + 1
-            r2 = getattr(r, 'response2', None)
-            d2[r2] = d2.get(r2, 0) + 1
-            r3 = getattr(r, 'finalVote', None)
-            d3[r3] = d3.get(r3, 0) + 1
-        return d1, d2, d3
+        '''return vote counts for the three rounds of response,
+        as dicts keyed by tally_key(category)'''
+        return self.roundCounts
 
+    @cached_page
     def analysis(self, title='Final Results'):
         if self.responses:
             f = 100. / len(self.responses)
         else: # avoid division by zero error
             f = 1.
         def perc(d, k):
-            return '%1.0f%%' % (d.get(k, 0) * f)
-        doc = webui.Document(title)
+            return '%1.0f%%' % (d.get(tally_key(k), 0) * f)
+        doc = webui.Document(title, self.pageHeader)
         doc.add_text('''<B>Instructions</B>: This table shows the
         fraction of students that got the correct answer,
         or gave no response (NR).  Uncategorized responses are not
@@ -703,20 +1042,18 @@ class QuestionBase(object):
         for i,category in enumerate(self.categoriesSorted):
             doc.add_text('Answer ' + letters[i], 'h2')
             doc.add_text(str(category))
+            k = tally_key(category)
             if self.categories[category]:
                 doc.add_text('Reasons Given for this Answer', 'h3')
-                for r in self.categories[category]:
-                    reasons = getattr(r, 'reasons', None)
-                    if reasons:
-                        doc.add_text(reasons, 'LI')
-            l = []
-            for r in self.responses.values():
-                if getattr(r, 'critiqueTarget', None) == category \
-                   and getattr(r, 'criticisms', None):
-                    l.append(r.criticisms)
+                for r in sort_by_uid(self.categoryReasons.get(k, {})):
+                    doc.add_text(r.reasons, 'LI')
+            l = sort_by_uid(self.critiques.get(k, {}))
             if l:
                 doc.add_text('Critiques of this Answer', 'h3')
-                for s in l:
+                for s, n in textcluster.collapse_duplicates([r.criticisms
+                                                             for r in l]):
+                    if n > 1: # near-duplicates are listed once
+                        s += ' (%d people)' % n
                     doc.add_text(s, 'LI')
             doc.add_text('<HR>\n')
         doc.add_text(self.server.admin_nav())
@@ -780,7 +1117,7 @@ class QuestionChoice(QuestionBase):
         for r in self.categories:
             if r == response:
                 response.prototype = r
-        self.responses[uid] = response
+        self.add_response(response)
         self.answer_monitor(monitor)
         return self.answer_msg()
 
@@ -823,6 +1160,7 @@ class QuestionText(QuestionBase):
         self._navHTML = self.nav_html()
         self.correctAnswer = TextResponse(0, self, 0, self.explanation)
         self.categories[self.correctAnswer] = []
+        self.duplicates = textcluster.DuplicateIndex() # of answers, by uid
         self.maxview = maxview
         self.doc.append(webui.Data(instructions))
         if enableMath:
@@ -840,20 +1178,64 @@ class QuestionText(QuestionBase):
         if missing_params(answer, confidence) or not answer:
             return _missing_arg_msg
         response = TextResponse(uid, self, confidence, answer)
-        self.responses[uid] = response
+        with self.lock: # its duplicate group must match the index
+            self.duplicates.add(uid, answer)
+            self.add_response(response)
         self.answer_monitor(monitor)
         ## self.alert_if_done(True)
         return self.answer_msg()
 
+    def duplicate_group(self, response):
+        return self.duplicates.group(response.uid)
+
+    def rank_categories(self):
+        '''rank categories by TF-IDF cosine similarity to each
+        uncategorized response, computed for all of them at once;
+        empty if numpy is not available'''
+        if textcluster.numpy is None:
+            return {}
+        responses = list(self.iter_unclustered())
+        rankings = textcluster.rank_categories([r.text for r in responses],
+                                               [c.text for c in
+                                                self.categoriesSorted])
+        return dict([(r.uid, l) for r, l in zip(responses, rankings)
+                     if l is not None])
+
+    def suggest_prototypes(self, minSimilarity=0.5):
+        '''list of (response, [similar responses]) grouping the
+        uncategorized responses by TF-IDF cosine similarity, largest
+        group first; responses with nothing similar are left out.
+        Recomputed only when the question state changes; empty if
+        numpy is not available.'''
+        if textcluster.numpy is None:
+            return []
+        try:
+            version, l = self._suggestions
+            if version == self.stateVersion:
+                return l
+        except AttributeError:
+            pass
+        responses = list(self.iter_unclustered())
+        l = [(responses[i], [responses[j] for j in members])
+             for i, members in textcluster.suggest_clusters(
+                 [r.text for r in responses], minSimilarity=minSimilarity)
+             if members]
+        self._suggestions = (self.stateVersion, l)
+        return l
+
     def add_correct(self):
         self.correctAnswer = TextResponse(0, self, 0, self.explanation)
         self.include_correct()
+        self.touch_all()
         self.init_vote()
         return 'Great.  ' + self._gotoVoteHTML
 
 
 class QuestionUpload(QuestionBase):
     maxSize = 500000 # don't show images bigger than 500kb
+    _instructionsHTML = '''(write your answer on a sheet of paper, take a picture,
+        and upload the picture using the button below.  Click here for
+        <A HREF="%s/images/help.html">some helpful instructions</A>).<br>\n'''
     def build_form(self, form, correctFile, stem='q',
                    imageDir='static/images', maxview=10, **kwargs):
         'ask the user to upload an image file'
@@ -868,9 +1250,9 @@ class QuestionUpload(QuestionBase):
         self._append_to_form(form)
 
     def _append_to_form(self, form, suffix='', conf=True,
-                        instructions='''(write your answer on a sheet of paper, take a picture,
-        and upload the picture using the button below.  Click here for
-        <A HREF="/images/help.html">some helpful instructions</A>).<br>\n'''):
+                        instructions=None):
+        if instructions is None: # static files are under our mount point
+            instructions = self._instructionsHTML % self.rootPath
         form.append(instructions)
         form.append(webui.Upload('image' + suffix))
         form.append('''<br>Optionally, you may enter a text answer, e.g. if
@@ -881,14 +1263,17 @@ class QuestionUpload(QuestionBase):
         form.append('<br>\n')
 
     def answer(self, uid, image=None, answer2='', confidence=None,
-               monitor=None):
-        'receive uploaded image file from user'
+               monitor=None, imagePath=None, hideMe=False):
+        '''receive uploaded image file from user, or (when replaying)
+        the imagePath and hideMe it was stored with'''
         if confidence is None or ((not image or not image.file)
-                                  and not answer2):
+                                  and not answer2 and not imagePath):
             return _missing_arg_msg
         size = 0
-        if getattr(image, 'file', None):
-            studentCode = self.courseDB.students[uid].code
+        if imagePath: # already stored
+            fname = imagePath
+        elif getattr(image, 'file', None):
+            studentCode = self.courseDB.student_code(uid)
             fname = 'q%d_%d_%s' % (self.id, studentCode, image.filename)
             ifile = open(os.path.join(self.imageDir, fname), 'wb')
             while True:
@@ -902,19 +1287,28 @@ class QuestionUpload(QuestionBase):
             fname = None
         if size > self.maxSize:
             hideMe = '(image too big to display)'
-        else:
-            hideMe = False
         response = ImageResponse(uid, self, confidence, fname, answer2,
                                  self.imageDir, hideMe)
-        self.responses[uid] = response
+        self.add_response(response)
         self.answer_monitor(monitor)
         ## self.alert_if_done(True)
         return self.answer_msg()
 
+    def replay_args(self, uid, stage):
+        'name of the stored image file, since uploads are not logged'
+        try:
+            r = self.responses[uid]
+        except KeyError:
+            return {}
+        if stage != 'answer' or not r.path:
+            return {}
+        return dict(imagePath=r.path, hideMe=r.hideMe)
+
     def add_correct(self):
         self.correctAnswer = ImageResponse(0, self, 0, self._correctFile, '',
                                            self.imageDir)
         self.include_correct()
+        self.touch_all()
         self.init_vote()
         return 'Great.  ' + self._gotoVoteHTML
 
@@ -952,6 +1346,7 @@ class QuestionSet(QuestionBase):
             r = q.answer(uid, confidence=0, **d2)
             if r == _missing_arg_msg: # student left something out...
                 return r
+        self.changed()
         if monitor:
             self.qsAnswered.add(uid)
             monitor.message('answers: %d / %d' % (len(self.qsAnswered),
@@ -960,6 +1355,13 @@ class QuestionSet(QuestionBase):
         <A HREF="index">continue</A>.'''
     answer.exposed = True
             
+    def replay_args(self, uid, stage):
+        d = {}
+        for i, q in enumerate(self.questions):
+            for k, v in q.replay_args(uid, stage).items():
+                d['%s_%d' % (k, i)] = v
+        return d
+
     def save_responses(self):
         n = 0
         for q in self.questions:
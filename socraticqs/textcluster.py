@@ -0,0 +1,229 @@
+try:
+    import numpy
+except ImportError: # without it, questions simply offer no suggestions
+    numpy = None
+import random
+import re
+import zlib
+from collections import OrderedDict
+
+_wordPattern = re.compile(r'\w+', re.UNICODE)
+# numbers, signs and operators, which change the meaning of an answer
+_exactPattern = re.compile(r'\d+(?:\.\d+)?|[-+*/^=<>!~|&%]', re.UNICODE)
+stopWords = frozenset('''a an and are as at be because by do does for from
+has have i if in is it its of on or so that the their then there these
+they this to was we were which will with'''.split())
+
+def tokenize(text):
+    'list of lowercased words of text, minus stop words'
+    return [w for w in _wordPattern.findall(text.lower())
+            if w not in stopWords]
+
+def tfidf_matrix(texts):
+    '''array of TF-IDF vectors (one row per text), each normalized to
+    unit length (or all zeros if the text has no words)'''
+    vocab = {}
+    docs = []
+    for text in texts:
+        d = {}
+        for w in tokenize(text):
+            j = vocab.setdefault(w, len(vocab))
+            d[j] = d.get(j, 0) + 1
+        docs.append(d)
+    X = numpy.zeros((len(docs), len(vocab)))
+    for i, d in enumerate(docs):
+        if d:
+            X[i, d.keys()] = d.values()
+    df = (X > 0).sum(0)
+    X *= numpy.log((1. + len(docs)) / (1. + df)) + 1. # smoothed idf
+    norms = numpy.sqrt((X * X).sum(1))
+    X[norms > 0] /= norms[norms > 0, numpy.newaxis]
+    return X
+
+def kmeans(X, k, niter=20, seed=0):
+    '''spherical k-means of the unit-length rows of X, using k-means++
+    seeding from a fixed seed so results are repeatable; returns
+    (labels, centers)'''
+    n = len(X)
+    rand = numpy.random.RandomState(seed)
+    centers = [rand.randint(n)]
+    dist = 1. - X.dot(X[centers[0]]) # cosine distance to nearest center
+    while len(centers) < k:
+        p = dist.clip(0)
+        if p.sum() <= 0: # all remaining points duplicate a center
+            break
+        j = rand.choice(n, p=p / p.sum())
+        centers.append(j)
+        dist = numpy.minimum(dist, 1. - X.dot(X[j]))
+    C = X[centers]
+    labels = None
+    for i in range(niter):
+        newLabels = X.dot(C.T).argmax(1)
+        if labels is not None and (newLabels == labels).all():
+            break
+        labels = newLabels
+        M = numpy.zeros((len(C), n))
+        M[labels, numpy.arange(n)] = 1.
+        S = M.dot(X) # sum of each cluster's members
+        norms = numpy.sqrt((S * S).sum(1))
+        nonEmpty = norms > 0 # empty clusters keep their old center
+        C[nonEmpty] = S[nonEmpty] / norms[nonEmpty, numpy.newaxis]
+    return labels, C
+
+def suggest_clusters(texts, k=None, minSimilarity=0.5):
+    '''group similar texts, returning a list of (i, [j, ...]) where
+    texts[i] is the member closest to its group's center and the j are
+    the other members whose cosine similarity with texts[i] is at least
+    minSimilarity; largest groups first.  k (the number of groups)
+    defaults to the square root of the number of texts with words.'''
+    X = tfidf_matrix(texts)
+    keep = numpy.flatnonzero(X.any(1))
+    if len(keep) < 2:
+        return []
+    if k is None:
+        k = int(round(numpy.sqrt(len(keep))))
+    labels, C = kmeans(X[keep], min(max(k, 1), len(keep)))
+    l = []
+    for j in range(len(C)):
+        members = keep[labels == j]
+        if not len(members):
+            continue
+        i = members[X[members].dot(C[j]).argmax()]
+        similar = (X[members].dot(X[i]) >= minSimilarity) & (members != i)
+        l.append((i, members[similar].tolist()))
+    l.sort(key=lambda t: (-len(t[1]), t[0]))
+    return [(int(i), members) for i, members in l]
+
+def rank_categories(texts, categoryTexts):
+    '''for each of texts, list of indexes of categoryTexts by decreasing
+    TF-IDF cosine similarity (ties in category order), or None if the
+    text shares no words with any category'''
+    n = len(texts)
+    X = tfidf_matrix(list(texts) + list(categoryTexts))
+    S = X[:n].dot(X[n:].T)
+    order = numpy.argsort(-S, axis=1, kind='mergesort')
+    return [order[i].tolist() if S[i].any() else None for i in range(n)]
+
+def normalize(text):
+    'text lowercased, with each run of whitespace replaced by one space'
+    return ' '.join(text.lower().split())
+
+def exact_tokens(text):
+    'tuple of the numbers, signs and operators in text, in order'
+    return tuple(_exactPattern.findall(text))
+
+def shingles(text, n=4):
+    '''set of n-character shingles of normalize(text), including its
+    punctuation, signs and operators'''
+    s = normalize(text)
+    if len(s) <= n:
+        return set([s])
+    return set([s[i:i + n] for i in range(len(s) - n + 1)])
+
+_prime = (1 << 61) - 1
+
+class DuplicateIndex(object):
+    '''incremental MinHash / LSH index grouping near-duplicate texts.
+    A new text joins the group of the most similar group leader (the
+    text that started the group) whose estimated Jaccard similarity
+    of shingles reaches threshold and whose exact_tokens() are the same
+    (so "-2" and "2", or "x+y" and "x-y", stay apart), or else starts
+    a new group.  Only
+    leaders sharing an LSH bucket with it are compared, so adding a
+    text does not scan the index.  Groups never merge, so a text keeps
+    its group ID until it is removed or replaced.'''
+    def __init__(self, threshold=0.9, bands=12, rows=4, seed=0):
+        rand = random.Random(seed)
+        self.hashes = [(rand.randrange(1, _prime), rand.randrange(_prime))
+                       for i in range(bands * rows)]
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = rows
+        self.buckets = {} # {(band, minhashes):set of group IDs}
+        self.leaders = {} # {groupID:signature of its leader}
+        self.leaderTokens = {} # {groupID:exact_tokens() of its leader}
+        self.groups = {} # {groupID:OrderedDict of its keys}
+        self.keyGroups = {} # {key:groupID}
+        self.nextGroup = 0
+
+    def signature(self, text):
+        'MinHash signature of text'
+        l = [zlib.crc32(s.encode('utf-8') if isinstance(s, unicode) else s)
+             & 0xffffffff for s in shingles(text)]
+        return [min([(a * x + b) % _prime for x in l]) for a, b in self.hashes]
+
+    def iter_buckets(self, sig):
+        for i in range(self.bands):
+            yield (i, tuple(sig[i * self.rows:(i + 1) * self.rows]))
+
+    def add(self, key, text):
+        'index text under key (replacing any previous text), returning its group ID'
+        self.remove(key)
+        sig = self.signature(text)
+        tokens = exact_tokens(text)
+        best = None
+        seen = set()
+        for bucket in self.iter_buckets(sig):
+            for groupID in self.buckets.get(bucket, ()):
+                if groupID in seen:
+                    continue
+                seen.add(groupID)
+                if self.leaderTokens[groupID] != tokens:
+                    continue
+                leader = self.leaders[groupID]
+                similarity = sum([x == y for x, y in zip(sig, leader)]) \
+                             / float(len(sig))
+                if similarity >= self.threshold and \
+                       (best is None or similarity > best[0]):
+                    best = (similarity, groupID)
+        if best:
+            groupID = best[1]
+        else: # start a new group, led by this text
+            groupID = self.nextGroup
+            self.nextGroup += 1
+            self.leaders[groupID] = sig
+            self.leaderTokens[groupID] = tokens
+            self.groups[groupID] = OrderedDict()
+            for bucket in self.iter_buckets(sig):
+                self.buckets.setdefault(bucket, set()).add(groupID)
+        self.groups[groupID][key] = True
+        self.keyGroups[key] = groupID
+        return groupID
+
+    def remove(self, key):
+        'remove key from the index, if present'
+        try:
+            groupID = self.keyGroups.pop(key)
+        except KeyError:
+            return
+        members = self.groups[groupID]
+        del members[key]
+        if not members: # drop the empty group
+            del self.groups[groupID]
+            del self.leaderTokens[groupID]
+            for bucket in self.iter_buckets(self.leaders.pop(groupID)):
+                l = self.buckets[bucket]
+                l.discard(groupID)
+                if not l:
+                    del self.buckets[bucket]
+
+    def group(self, key):
+        'group ID of key, or None if it is not indexed'
+        return self.keyGroups.get(key)
+
+    def members(self, groupID):
+        'list of keys in group, in order of addition'
+        return list(self.groups.get(groupID, ()))
+
+def collapse_duplicates(texts, threshold=0.9):
+    '''group near-duplicate texts, returning a list of (text, count) with
+    the first text of each group, in order of first appearance'''
+    index = DuplicateIndex(threshold)
+    counts = OrderedDict()
+    for i, text in enumerate(texts):
+        groupID = index.add(i, text)
+        try:
+            counts[groupID][1] += 1
+        except KeyError:
+            counts[groupID] = [text, 1]
+    return [tuple(t) for t in counts.values()]
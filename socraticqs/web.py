@@ -2,10 +2,12 @@ import cherrypy
 import webui
 import thread
 import forms
-from coursedb import CourseDB
+from coursedb import CourseDB, CourseRouter
 from question import QuestionSet
+import journal
 import warnings
-import os.path
+import os
+import time
 
 def redirect(path='/', body=None, delay=0):
     'redirect browser, if desired after showing a message'
@@ -35,19 +37,33 @@ def check_static_path(config, path):
 class Server(object):
     '''provides dynamic interfaces for students and instructor.
     Intended to be run from Python console, retaining control via the
-    console thread; the cherrypy server runs using background threads.'''
+    console thread; the cherrypy server runs using background threads.
+    If course is given, its database is opened via router (by default,
+    a CourseRouter for the current directory) and the server is mounted
+    at /course, so several courses can be served side by side.'''
     def __init__(self, questionFile, enableMathJax=True, registerAll=False,
                  adminIP='127.0.0.1', monitorClass=TrivialMonitor,
                  mathJaxPath='/MathJax/MathJax.js?config=TeX-AMS-MML_HTMLorMML',
                  configPath='cp.conf', rootPath='', 
-                 shutdownFunc=None, **kwargs):
+                 shutdownFunc=None, journalFile=None, checkpointInterval=30.,
+                 course=None, router=None, **kwargs):
+        mountPath = '/'
+        if course:
+            if router is None:
+                router = CourseRouter()
+            kwargs['dbfile'] = router.dbfile(course)
+            mountPath += course
+            rootPath += mountPath
         if configPath:
-            self.app = cherrypy.tree.mount(self, '/', configPath)
+            self.app = cherrypy.tree.mount(self, mountPath, configPath)
             try:
                 cherrypy.config.update(self.app.config['global'])
             except KeyError:
                 pass
+            if course: # separate login session for each course
+                self.app.merge({'/': {'tools.sessions.path': mountPath}})
         self.enableMathJax = enableMathJax
+        self.pageHeader = None # per-course, so mounted courses don't collide
         if enableMathJax:
             if configPath and mathJaxPath is not None and \
                mathJaxPath.startswith('/') and \
@@ -57,23 +73,107 @@ class Server(object):
                 mathJaxPath = None
             if mathJaxPath is None: # fallback to MathJax CDN
                 mathJaxPath = 'http://cdn.mathjax.org/mathjax/latest/MathJax.js?config=TeX-AMS-MML_HTMLorMML'
-            webui.Document._defaultHeader = '''<script type="text/javascript"
+            elif mathJaxPath.startswith('/'): # served under our mount point
+                mathJaxPath = rootPath + mathJaxPath
+            self.pageHeader = '''<script type="text/javascript"
   src="%s">
 </script>
 ''' % mathJaxPath
         self.adminIP = adminIP
         self.root = rootPath
+        self.course = course
         self.shutdownFunc = shutdownFunc
-        self.courseDB = CourseDB(questionFile, enableMath=enableMathJax,
-                                 **kwargs)
-        self._registerHTML = forms.register_form()
+        if journalFile is None: # default: journal next to the database
+            journalFile = kwargs.get('dbfile', 'course.db') + '.journal'
+        records = ()
+        if journalFile:
+            records = journal.read_journal(journalFile)
+        questionHash = journal.file_hash(questionFile)
+        if records and (records[0]['kind'] != 'session' or
+                        records[0]['questionFile'] != questionFile or
+                        records[0].get('questionHash') != questionHash):
+            warnings.warn('''journal %s does not match %s (or the file
+            has changed), so it will not be replayed.
+            Moving it to %s.old'''
+                          % (journalFile, questionFile, journalFile))
+            os.rename(journalFile, journalFile + '.old')
+            records = ()
+        if records: # recover crashed session using its question rows
+            kwargs['questionIDs'] = records[0]['questions']
+        if course:
+            del kwargs['dbfile'] # router supplies it
+            self.courseDB = router.get(course, questionFile,
+                                       enableMath=enableMathJax,
+                                       rootPath=rootPath,
+                                       pageHeader=self.pageHeader, **kwargs)
+        else:
+            self.courseDB = CourseDB(questionFile, enableMath=enableMathJax,
+                                     rootPath=rootPath,
+                                     pageHeader=self.pageHeader, **kwargs)
+        self._registerHTML = forms.register_form(header=self.pageHeader)
         self.registerAll = registerAll
-        self._loginHTML = forms.login_form()
+        self._loginHTML = forms.login_form(header=self.pageHeader)
         self._reloadHTML = redirect(rootPath + '/index')
         self.questions = {}
+        self._journaledRowIDs = {} # {(qid, uid):(rowID, errorIDs)}
         if questionFile:
             self.serve_question(self.courseDB.questions[0])
+        self.journal = None
+        if journalFile:
+            self.journal = journal.Journal(journalFile, self.checkpoint,
+                                           checkpointInterval)
+            if records:
+                self.replay_journal(records[1:])
+            else:
+                self.journal.append('session', questionFile=questionFile,
+                                    questionHash=questionHash,
+                                    questions=self.get_question_ids())
         self.monitor = monitorClass()
+
+    def get_question_ids(self):
+        'list of (questionID, errorIDs) for every loaded question'
+        return [(q.id, q.errorIDs) for q in
+                getattr(self.courseDB, 'questions', ())]
+
+    def replay_journal(self, records):
+        'rebuild live question state from journal records after a crash'
+        n = 0
+        for record in records:
+            kind = record['kind']
+            if kind == 'submit':
+                q = self.questions[record['qid']]
+                q.submitStages[record['stage']](record['uid'],
+                                                **record['args'])
+                self.courseDB.log_event(q.id, record['uid'], record['stage'],
+                                        record['args'], record['time'])
+                n += 1
+            elif kind == 'admin':
+                self.get_admin_func(record['action'])(**record['args'])
+                self.log_admin_event(record['action'], record['args'],
+                                     record['time'])
+            elif kind == 'saved': # restore primary keys already in db
+                questions = dict([(q.id, q) for q in self.courseDB.questions])
+                questions.update(self.questions)
+                for qid, rowIDs in record['rowIDs'].items():
+                    responses = questions[int(qid)].responses
+                    for uid, rowID, errorIDs in rowIDs:
+                        try:
+                            r = responses[uid]
+                        except KeyError:
+                            continue
+                        r.id = rowID
+                        r.savedErrorIDs = errorIDs
+                        self._journaledRowIDs[(int(qid), uid)] = \
+                            (rowID, errorIDs)
+            elif kind == 'reload':
+                if journal.file_hash(record['questionFile']) \
+                       != record.get('questionHash'):
+                    raise ValueError('%s has changed since it was loaded'
+                                     % record['questionFile'])
+                self.courseDB.load_question_file(record['questionFile'],
+                                        questionIDs=record['questions'])
+        self.courseDB.flush_events()
+        print 'Recovered %d submissions from %s' % (n, self.journal.path)
     
     def serve_question(self, question):
         'set the question to be posed to the students'
@@ -179,7 +279,7 @@ class Server(object):
             return q._viewHTML[stage] # just return stored HTML
         except KeyError:
             if stage == 'cluster':
-                return q.cluster_form(uid)
+                return q.cluster_form(uid, kwargs.get('showAll', ''))
             print 'ERROR: Unknown stage:', stage
             return '''An error occurred.  Please skip to the next step.'''
     view.exposed = True
@@ -202,19 +302,40 @@ class Server(object):
             print 'ERROR: Unknown stage:', stage
             return '''An error occurred.  Please either try to resubmit your
             form, or skip to the next step.'''
-        return action(uid, monitor=self.monitor, **kwargs)
+        with q.lock: # one submission at a time, journaled in that order
+            t = time.time()
+            result = action(uid, monitor=self.monitor, **kwargs)
+            args = journal.serializable_args(kwargs)
+            args.update(q.replay_args(uid, stage)) # e.g. stored upload name
+            if self.journal: # same time, so replay won't duplicate it
+                self.journal.append('submit', qid=q.id, uid=uid, stage=stage,
+                                    args=args, time=t)
+        self.courseDB.log_event(q.id, uid, stage, args, t)
+        return result
     submit.exposed = True
 
     # instructor interfaces
-    def auth_admin(self, func, **kwargs):
+    def auth_admin(self, func, action=None, **kwargs):
         if cherrypy.request.remote.ip == self.adminIP:
-            return func(**kwargs)
+            with self.question.lock: # not interleaved with submissions
+                version = getattr(self.question, 'stateVersion', None)
+                result = func(**kwargs)
+                if action in self._journaledActions or \
+                       (action in self._viewActions and version !=
+                        getattr(self.question, 'stateVersion', None)):
+                    args = journal.serializable_args(kwargs)
+                    t = time.time()
+                    self.log_admin_event(action, args, t)
+                    if self.journal: # same time, so replay won't duplicate it
+                        self.journal.append('admin', action=action, args=args,
+                                            time=t)
+            return result
         else:
             cherrypy.response.status = 401
             return '<h1>Access denied</h1>'
 
     def _admin_page(self):
-        doc = webui.Document('Socraticqs Console')
+        doc = webui.Document('Socraticqs Console', self.pageHeader)
         doc.add_text('%d students logged in.' % len(self.courseDB.logins))
         doc.add_text('Concept Tests', 'h1')
         for i,q in enumerate(self.courseDB.questions):
@@ -255,6 +376,9 @@ class Server(object):
 
     def _exit(self):
         s = self.save_all_responses()
+        if self.journal: # everything saved, so no need to replay it
+            self.journal.close(remove=True)
+            self.journal = None
         if self.shutdownFunc:
             return self.shutdownFunc(self, s)
         else:
@@ -277,9 +401,49 @@ class Server(object):
              quiz_form='self._quiz_form',
              quizmode='self._start_quiz')
     for name,funcstr in d.items(): # create authenticated admin methods
-        exec '''%s=lambda self, **kwargs:self.auth_admin(%s, **kwargs)
-%s.exposed = True''' % (name, funcstr, name)
-    del d # don't leave this cluttering the class attributes
+        exec '''%s=lambda self, **kwargs:self.auth_admin(%s, '%s', **kwargs)
+%s.exposed = True''' % (name, funcstr, name, name)
+    _adminFuncs = d # used for replaying admin actions from journal
+    del d
+    # admin actions that change question state, so must be journaled
+    _journaledActions = frozenset(('start_question', 'add_prototypes',
+                                   'correct', 'add_correct', 'quizmode'))
+    # page views journaled only when they changed the question's
+    # stateVersion (e.g. starting its timer or showing its answer)
+    _viewActions = frozenset(('qadmin', 'qassess', 'cluster_report'))
+
+    # question.adminStages method recorded in the events table for each
+    # admin action that changed question state
+    _adminEvents = dict(qadmin='start_timer', qassess='show_answer',
+                        cluster_report='init_vote',
+                        add_prototypes='add_categories', correct='correct',
+                        add_correct='add_correct')
+
+    def log_admin_event(self, action, args, eventTime):
+        'log an admin action that changed question state as an event'
+        try:
+            stage = self._adminEvents[action]
+        except KeyError: # does not change question state
+            return
+        if action == 'qadmin' and not args.get('starttimer'):
+            return # timer was not started
+        if action == 'cluster_report' \
+               and not hasattr(self.question, 'correctAnswer'):
+            return # vote not started
+        if stage not in ('add_categories', 'correct'): # take no arguments
+            args = {}
+        self.courseDB.log_event(self.question.id, self.courseDB.adminUID,
+                                stage, args, eventTime)
+
+    def get_admin_func(self, action):
+        'look up the function for a journaled admin action, for replay'
+        if action not in self._journaledActions \
+               and action not in self._viewActions:
+            raise ValueError('cannot replay admin action ' + repr(action))
+        func = self
+        for name in self._adminFuncs[action].split('.')[1:]:
+            func = getattr(func, name)
+        return func
 
     # test aurigma up support
     def aurigma_up(self, uid, PackageFileCount, **kwargs):
@@ -293,7 +457,7 @@ class Server(object):
     aurigma_up.exposed = True
 
     def _quiz_form(self):
-        return forms.build_quizmode_form()
+        return forms.build_quizmode_form(header=self.pageHeader)
 
     def _start_quiz(self, **kwargs):
         self.start_quiz(**kwargs)
@@ -323,25 +487,67 @@ class Server(object):
 
     def reload(self, qfile):
         self.courseDB.load_question_file(qfile)
+        if self.journal:
+            self.journal.append('reload', questionFile=qfile,
+                                questionHash=journal.file_hash(qfile),
+                                questions=self.get_question_ids())
         print 'Loaded %d questions' % len(self.courseDB.questions)
 
     def save_all_responses(self):
+        self.courseDB.flush_events()
         if isinstance(self.question, QuestionSet):
-            return self.question.save_responses()
+            s = self.question.save_responses()
+            self.journal_row_ids(self.question.questions)
+            return s
         n = 0
         for q in self.questions.values():
             n += self.courseDB.save_responses(q)
+        self.journal_row_ids(self.questions.values())
         s = 'Saved %d responses.\n' % n
         s += self.admin_nav()
         return s
+
+    def checkpoint(self):
+        'periodically called by journal thread to save responses to db'
+        self.courseDB.flush_events()
+        if isinstance(self.question, QuestionSet):
+            questions = self.question.questions
+        else:
+            questions = self.questions.values()
+        for q in questions:
+            self.courseDB.save_responses(q)
+        self.journal_row_ids(questions)
+
+    def journal_row_ids(self, questions):
+        '''record newly saved primary keys (and error IDs), so replay
+        will not duplicate db rows'''
+        if not self.journal:
+            return
+        d = {}
+        for q in questions:
+            l = []
+            for r in q.responses.values():
+                if not hasattr(r, 'id'):
+                    continue
+                saved = (r.id, list(getattr(r, 'savedErrorIDs', ())))
+                if self._journaledRowIDs.get((q.id, r.uid)) != saved:
+                    self._journaledRowIDs[(q.id, r.uid)] = saved
+                    l.append((r.uid,) + saved)
+            if l:
+                d[q.id] = l
+        if d:
+            self.journal.append('saved', rowIDs=d)
         
 
 def main():
     'start socraticqs web server with the specified questions CSV file'
     import sys
     if len(sys.argv) < 2:
-        print 'Usage: %s QUESTIONFILE.csv' % sys.argv[0]
-    s = Server(sys.argv[1])
+        print 'Usage: %s QUESTIONFILE.csv [COURSE]' % sys.argv[0]
+    course = None
+    if len(sys.argv) > 2: # serve this course's database shard
+        course = sys.argv[2]
+    s = Server(sys.argv[1], course=course)
     s.serve_forever()
 
 if __name__ == '__main__':
@@ -44,12 +44,13 @@ class Title(Data):
     format='TITLE'
 class Document(Data):
     format='HTML'
-    def __init__(self,title):
+    def __init__(self,title,header=None):
+        'header: optional HTML for <head>, e.g. a script tag'
         head=Head([Title([title])])
-        try:
-            head.append(self._defaultHeader)
-        except AttributeError:
-            pass
+        if header is None:
+            header = getattr(self, '_defaultHeader', None)
+        if header:
+            head.append(header)
         list.__init__(self,[head,Body()])
         self.head=head
         self.methods={}
@@ -1,15 +1,36 @@
 import coursedb
-import sys
+import os.path
+from optparse import OptionParser
 
 def main():
-    if len(sys.argv) < 2:
-        print 'Usage: %s RSTOUTFILE [QUESTIONLIST]' % sys.argv[0]
-    courseDB = coursedb.CourseDB() # connect to default DB
-    if len(sys.argv) > 2:
-        qlist = [int(s) for s in sys.argv[2].split(',')]
+    parser = OptionParser(usage='%prog [options] RSTOUTFILE [QUESTIONLIST]')
+    parser.add_option('-j', '--jobs', type='int', default=1,
+                      help='render questions in N worker processes [default: %default]')
+    parser.add_option('--no-cache', action='store_false', dest='useCache',
+                      default=True,
+                      help='re-render every question instead of reusing unchanged sections')
+    parser.add_option('--numpy', action='store_true', default=False,
+                      help='compute statistics using NumPy arrays cached next to the database')
+    coursedb.add_course_options(parser)
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('no RSTOUTFILE given')
+    if len(args) > 1:
+        qlist = [int(s) for s in args[1].split(',')]
     else:
         qlist = None
-    courseDB.write_report(sys.argv[1], qlist)
+    for course, dbfile in coursedb.course_dbfiles(parser, options):
+        rstfile = args[0]
+        if options.all_courses: # one report per course
+            base, ext = os.path.splitext(rstfile)
+            rstfile = '%s-%s%s' % (base, course, ext)
+            print 'writing', rstfile
+        courseDB = coursedb.CourseDB(dbfile=dbfile)
+        if options.numpy:
+            import analytics
+            courseDB.analytics = analytics.Analytics(dbfile)
+        courseDB.write_report(rstfile, qlist, jobs=options.jobs,
+                              useCache=options.useCache)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,83 @@
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'socraticqs'))
+import coursedb
+try:
+    import numpy
+    import analytics
+except ImportError: # analytics needs numpy
+    numpy = None
+
+questionFile = os.path.join(os.path.dirname(__file__), '..', 'examples',
+                            'questions1.csv')
+
+@unittest.skipIf(numpy is None, 'numpy not installed')
+class RefreshTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.tmpdir, 'course.db')
+        ifile = open(questionFile, 'rb')
+        row = [t for t in csv.reader(ifile) if t[0] == 'text'][0]
+        ifile.close()
+        path = os.path.join(self.tmpdir, 'questions.csv')
+        ofile = open(path, 'wb')
+        csv.writer(ofile).writerows([row, row]) # two questions with errors
+        ofile.close()
+        self.db = coursedb.CourseDB(path, dbfile=self.dbfile)
+        for i in range(6):
+            self.db.add_student(1000 + i, 'u%d' % i, 'User %d' % i, 1000 + i)
+
+    def tearDown(self):
+        self.db.pool.close()
+        shutil.rmtree(self.tmpdir)
+
+    def answer(self, q, uids, error):
+        for uid in uids:
+            if hasattr(q, 'choices'):
+                q.answer(uid, choice='1', confidence='1')
+            else:
+                q.answer(uid, answer='an answer', confidence='1')
+            q.assess(uid, assessment='different', errors=(str(error),),
+                     differences='')
+        self.db.save_responses(q)
+
+    def sql_counts(self, c):
+        c.execute('select count(*) from responses')
+        nresponses = c.fetchone()[0]
+        c.execute('''select t1.error_id, count(*) from student_errors t1,
+        error_models t2 where t1.error_id=t2.id group by t1.error_id''')
+        return nresponses, dict(c.fetchall())
+
+    def array_counts(self, a):
+        stats = a.question_stats()
+        errorCounts = {}
+        for s in stats.values():
+            errorCounts.update(s.errorCounts)
+        return sum([s.count() for s in stats.values()]), errorCounts
+
+    def test_refresh_after_inserts(self):
+        'incremental refresh must match the database, without double counts'
+        q1, q2 = self.db.questions
+        # save q2's errors (higher error_ids) first, so the rowid order
+        # differs from the error_id order of the student_errors join
+        self.answer(q2, (1000, 1001), 0)
+        self.answer(q1, (1000, 1001), 0)
+        c = self.db.pool.connect().cursor()
+        a = analytics.Analytics(self.dbfile)
+        a.refresh(c)
+        self.assertEqual(self.array_counts(a), self.sql_counts(c))
+        self.answer(q2, (1002, 1003), 1) # q1 unchanged
+        a.refresh(c)
+        self.assertEqual(self.array_counts(a), self.sql_counts(c))
+        a = analytics.Analytics(self.dbfile) # from the cache files
+        self.answer(q2, (1004,), 2)
+        a.refresh(c)
+        self.assertEqual(self.array_counts(a), self.sql_counts(c))
+
+if __name__ == '__main__':
+    unittest.main()
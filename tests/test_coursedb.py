@@ -0,0 +1,65 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'socraticqs'))
+import coursedb
+
+questionFile = os.path.join(os.path.dirname(__file__), '..', 'examples',
+                            'questions1.csv')
+
+class SaveResponsesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = coursedb.CourseDB(questionFile, dbfile=os.path.join(
+            self.tmpdir, 'course.db'))
+        self.db.add_student(1001, 'alice', 'Alice Smith', 1001)
+        self.q = [q for q in self.db.questions if q.errorIDs][0]
+
+    def tearDown(self):
+        self.db.pool.close()
+        shutil.rmtree(self.tmpdir)
+
+    def saved_errors(self):
+        c = self.db.pool.connect().cursor()
+        c.execute('select error_id, uid from student_errors')
+        return sorted(c.fetchall())
+
+    def test_errors_after_checkpoint(self):
+        'errors reported after the first save must still reach the db'
+        q = self.q
+        if hasattr(q, 'choices'):
+            q.answer(1001, choice='0', confidence='1')
+        else:
+            q.answer(1001, answer='some answer', confidence='1')
+        self.db.save_responses(q) # checkpoint: inserts the response row
+        q.assess(1001, assessment='different', errors=('0',),
+                 differences='')
+        self.db.save_responses(q) # now an update
+        self.assertEqual(self.saved_errors(), [(q.errorIDs[0], 1001)])
+        q.assess(1001, assessment='different', errors=('0', '1'),
+                 differences='')
+        self.db.save_responses(q)
+        self.assertEqual(self.saved_errors(),
+                         sorted([(q.errorIDs[0], 1001),
+                                 (q.errorIDs[1], 1001)]))
+
+    def test_errors_removed(self):
+        'errors a student no longer reports must be removed from the db'
+        q = self.q
+        q.answer(1001, answer='some answer', confidence='1')
+        q.assess(1001, assessment='different', errors=('0',),
+                 differences='')
+        self.db.save_responses(q) # checkpoint
+        q.assess(1001, assessment='different', errors=('1',),
+                 differences='')
+        self.db.save_responses(q)
+        self.assertEqual(self.saved_errors(), [(q.errorIDs[1], 1001)])
+        q.assess(1001, assessment='close', errors=(), differences='')
+        self.db.save_responses(q)
+        self.assertEqual(self.saved_errors(), [])
+
+if __name__ == '__main__':
+    unittest.main()
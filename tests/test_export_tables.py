@@ -0,0 +1,50 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'socraticqs'))
+try:
+    import numpy
+    import export_tables
+except ImportError: # .npz export needs numpy
+    numpy = None
+
+@unittest.skipIf(numpy is None, 'numpy not installed')
+class ConcatenateColumnsTest(unittest.TestCase):
+    def check(self, values, unsigned=False, batchSize=3):
+        'batched conversion must match converting all values at once'
+        batches = [export_tables.column_array(values[i:i + batchSize],
+                                              unsigned)
+                   for i in range(0, len(values), batchSize)]
+        a, isnull = export_tables.concatenate_columns(batches, unsigned)
+        b, isnull2 = export_tables.column_array(values, unsigned)
+        self.assertEqual(a.dtype, b.dtype)
+        self.assertEqual(map(repr, a.tolist()), map(repr, b.tolist())) # NaNs
+        if isnull2 is None:
+            self.assertTrue(isnull is None)
+        else:
+            self.assertEqual(isnull.tolist(), isnull2.tolist())
+
+    def test_promotion(self):
+        self.check([1, 2, 3, 4, 5, 6, 7])
+        self.check([None, None, None, 1, 2, None, 3])
+        self.check([1, 2, 3, 1.5, None, 2, None])
+        self.check([1, 2, 3, 4, 5, 1 << 63, 7])
+        self.check([1, 2, 3, 4, 5, 6, 7], unsigned=True)
+        self.check([1, None, 3, 2.5, u'x', None, u'\xe9'])
+        self.check([None, None, None, None])
+        self.check([])
+
+    def test_random(self):
+        rand = random.Random(1)
+        for choices in ((None, 0, 7, -3, 2.25), (None, 0, 7, 1 << 63),
+                        (None, 0, 7, -3, u'a', u'bc')):
+            for i in range(200):
+                values = [rand.choice(choices[:rand.randint(1,
+                                                            len(choices))])
+                          for j in range(rand.randint(0, 12))]
+                self.check(values, batchSize=rand.randint(1, 5))
+
+if __name__ == '__main__':
+    unittest.main()
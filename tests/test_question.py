@@ -0,0 +1,101 @@
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'socraticqs'))
+import coursedb
+import question
+import textcluster
+
+questionFile = os.path.join(os.path.dirname(__file__), '..', 'examples',
+                            'questions1.csv')
+
+class FakeServer(object):
+    def admin_nav(self):
+        return ''
+
+class PrototypeFormTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = coursedb.CourseDB(questionFile, dbfile=os.path.join(
+            self.tmpdir, 'course.db'))
+        self.q = [q for q in self.db.questions
+                  if isinstance(q, question.QuestionText)][0]
+        self.q.server = FakeServer()
+
+    def tearDown(self):
+        self.db.pool.close()
+        shutil.rmtree(self.tmpdir)
+
+    def answer(self, uids, text):
+        for uid in uids:
+            self.q.answer(uid, answer=text % uid, confidence='1')
+
+    def form_members(self, s):
+        'dict of {uid:[member uid, ...]} from the hidden members_UID fields'
+        return dict([(int(uid), [int(m) for m in members.split(',') if m])
+                     for uid, members in
+                     re.findall(r'name="members_(\d+)" value="([\d,]*)"', s,
+                                re.IGNORECASE)])
+
+    @unittest.skipIf(textcluster.numpy is None, 'numpy not installed')
+    def test_stale_suggestions(self):
+        'add group must add the members shown, not recomputed suggestions'
+        q = self.q
+        self.answer(range(1000, 1006), 'use bayes rule to invert it %d')
+        self.answer(range(1006, 1012), 'sum over all the hidden states %d')
+        shown = self.form_members(q.prototype_form())
+        self.assertTrue(shown)
+        self.answer(range(1012, 1018), 'use bayes rule to invert it %d')
+        uid = min(shown)
+        members = shown[uid]
+        kwargs = {'resp_%d' % uid: 'group'}
+        kwargs['members_%d' % uid] = ','.join(map(str, members))
+        q.add_prototypes(**kwargs)
+        category = q.responses[uid]
+        self.assertEqual(sorted([r.uid for r in q.categories[category]]),
+                         sorted([uid] + members))
+
+class ThreadedAnswerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = coursedb.CourseDB(questionFile, dbfile=os.path.join(
+            self.tmpdir, 'course.db'))
+        self.q = [q for q in self.db.questions
+                  if isinstance(q, question.QuestionText)][0]
+        self.checkInterval = sys.getcheckinterval()
+        sys.setcheckinterval(1) # switch threads as often as possible
+
+    def tearDown(self):
+        sys.setcheckinterval(self.checkInterval)
+        self.db.pool.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_tallies(self):
+        'answers from many server threads must all be tallied'
+        q = self.q
+        def answer(start):
+            for i in range(3): # later rounds replace earlier answers
+                for uid in range(start, start + 300):
+                    q.answer(uid, answer='answer %d' % ((uid + i) % 7),
+                             confidence=str((uid + i) % 3))
+        threads = [threading.Thread(target=answer, args=(1000 * (i + 1),))
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(q.responses), 2400)
+        self.assertEqual(sum(q.confidenceCounts.values()), 2400)
+        self.assertEqual(sum(q.roundCounts[0].values()), 2400)
+        self.assertEqual(len(q.unclustered), 2400)
+        self.assertEqual(sum([len(g) for g in q.unclusteredGroups.values()]),
+                         2400)
+        self.assertEqual(q.stateVersion, 7200)
+
+if __name__ == '__main__':
+    unittest.main()
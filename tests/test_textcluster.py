@@ -0,0 +1,38 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'socraticqs'))
+import textcluster
+
+class CollapseDuplicatesTest(unittest.TestCase):
+    def test_identical(self):
+        'case and whitespace differences are collapsed'
+        self.assertEqual(textcluster.collapse_duplicates(
+            ['Use Bayes rule', 'use  bayes rule', 'use bayes rule\n']),
+            [('Use Bayes rule', 3)])
+
+    def test_meaningful_differences(self):
+        'signs, operators and numbers keep answers apart'
+        for texts in (['-2', '2'], ['x+y', 'x-y'], ['a < b', 'a > b'],
+                      ['the answer is 0.25', 'the answer is 0.35'],
+                      ['p(A|B) = p(B|A)p(A)/p(B)',
+                       'p(A|B) = p(B|A)p(A)*p(B)']):
+            self.assertEqual(textcluster.collapse_duplicates(texts),
+                             [(t, 1) for t in texts])
+
+class DuplicateIndexTest(unittest.TestCase):
+    def test_remove(self):
+        index = textcluster.DuplicateIndex()
+        g = index.add(1, 'sum over all hidden states')
+        self.assertEqual(index.add(2, 'Sum over all hidden states'), g)
+        self.assertNotEqual(index.add(3, 'sum over all 3 hidden states'), g)
+        index.remove(1)
+        self.assertEqual(index.members(g), [2])
+        index.remove(2)
+        self.assertEqual(index.group(2), None)
+        self.assertEqual(index.add(4, 'sum over all hidden states'),
+                         index.group(4))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'socraticqs'))
+try:
+    import cherrypy
+    import web
+    import journal
+    import coursedb
+except ImportError: # web server tests need cherrypy
+    cherrypy = None
+
+questionFile = os.path.join(os.path.dirname(__file__), '..', 'examples',
+                            'questions1.csv')
+
+class FakeUpload(object):
+    'stands in for an uploaded file field'
+    def __init__(self, filename, data):
+        self.filename = filename
+        self.file = StringIO.StringIO(data)
+
+@unittest.skipIf(cherrypy is None, 'cherrypy not installed')
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.questionFile = os.path.join(self.tmpdir, 'questions.csv')
+        shutil.copy(questionFile, self.questionFile)
+        self.dbfile = os.path.join(self.tmpdir, 'course.db')
+        self.servers = []
+        # only a request through the sessions tool creates cherrypy.session
+        self.oldSession = getattr(cherrypy, 'session', None)
+        cherrypy.session = {}
+
+    def tearDown(self):
+        for s in self.servers:
+            if s.journal:
+                s.journal.close()
+            s.courseDB.pool.close()
+        shutil.rmtree(self.tmpdir)
+        if self.oldSession is None:
+            del cherrypy.session
+        else:
+            cherrypy.session = self.oldSession
+
+    def start_server(self):
+        s = web.Server(self.questionFile, configPath=None,
+                       dbfile=self.dbfile, checkpointInterval=3600.)
+        self.servers.append(s)
+        return s
+
+    def submit(self, s, uid, stage, **kwargs):
+        cherrypy.session['UID'] = uid
+        return s.submit(stage, str(s.question.id), **kwargs)
+
+    def crash(self, s):
+        'stop journaling without saving, as if the server died'
+        s.journal.close()
+        s.journal = None
+
+    def test_replay(self):
+        s = self.start_server()
+        for i in range(4):
+            s.courseDB.add_student(1000 + i, 'u%d' % i, 'User %d' % i,
+                                   1000 + i)
+        s.start_question(q='1')
+        q = s.question
+        for i in range(4):
+            self.submit(s, 1000 + i, 'answer', answer='answer %d' % (i % 2),
+                        confidence='1')
+        s.checkpoint()
+        s.qadmin() # page views are not journaled
+        s.prototype_form()
+        s.qassess() # but this one shows the answer to students
+        for i in range(4):
+            self.submit(s, 1000 + i, 'assess', assessment='different',
+                        errors=['0'], differences='')
+        s.add_prototypes(resp_1000='add')
+        s.checkpoint()
+        self.crash(s)
+        records = journal.read_journal(self.dbfile + '.journal')
+        self.assertEqual([r['action'] for r in records
+                          if r['kind'] == 'admin'],
+                         ['start_question', 'qassess', 'add_prototypes'])
+        saved = [r['rowIDs'] for r in records if r['kind'] == 'saved']
+        self.assertEqual([len(d[str(q.id)]) for d in saved], [4, 4])
+
+        s2 = self.start_server()
+        q2 = s2.question
+        self.assertEqual(sorted(q2.responses), sorted(q.responses))
+        self.assertEqual(len(q2.categories), len(q.categories))
+        self.assertTrue(q2.showAnswer)
+        s2.save_all_responses()
+        c = s2.courseDB.pool.connect().cursor()
+        c.execute('select count(*) from responses')
+        self.assertEqual(c.fetchone()[0], 4)
+        c.execute('select count(*) from student_errors')
+        self.assertEqual(c.fetchone()[0], 4)
+
+    def test_replay_events(self):
+        'events must include the admin actions that changed the question'
+        s = self.start_server()
+        for i in range(4):
+            s.courseDB.add_student(1000 + i, 'u%d' % i, 'User %d' % i,
+                                   1000 + i)
+        s.start_question(q='1')
+        q = s.question
+        s.qadmin(starttimer='1')
+        for i in range(4):
+            self.submit(s, 1000 + i, 'answer', answer='answer %d' % (i % 2),
+                        confidence='1')
+        s.qassess()
+        s.add_prototypes(resp_1000='add', resp_1001='add')
+        for i in range(2, 4):
+            self.submit(s, 1000 + i, 'assess', assessment='different',
+                        errors=['0'], differences='')
+        s.courseDB.flush_events()
+        q2 = coursedb.CourseDB(self.questionFile,
+                               dbfile=self.dbfile).questions[1]
+        self.assertEqual(s.courseDB.replay_events(q2, questionID=q.id), 9)
+        self.assertTrue(hasattr(q2, 'starttime'))
+        self.assertTrue(q2.showAnswer)
+        self.assertEqual(len(q2.categories), len(q.categories))
+        self.assertEqual(q2.count_unclustered(), q.count_unclustered())
+        self.assertEqual(sorted(q2.isClustered), sorted(q.isClustered))
+
+    def test_replay_upload(self):
+        'an uploaded answer must keep its stored file across a crash'
+        ofile = open(self.questionFile, 'wb')
+        ofile.write('image,A Sketch,Draw it.,Like this.,0,correct.png,q,%s\n'
+                    % self.tmpdir)
+        ofile.close()
+        s = self.start_server()
+        s.courseDB.add_student(1000, 'u0', 'User 0', 1000)
+        s.start_question(q='0')
+        self.submit(s, 1000, 'answer', image=FakeUpload('a.png', 'PNG'),
+                    answer2='my sketch', confidence='1')
+        path = s.question.responses[1000].path
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, path)))
+        s.checkpoint()
+        self.crash(s)
+        s2 = self.start_server()
+        self.assertEqual(s2.question.responses[1000].path, path)
+        s2.save_all_responses()
+        c = s2.courseDB.pool.connect().cursor()
+        c.execute('select attach_path, answer from responses')
+        self.assertEqual(c.fetchall(), [(path, u'my sketch')])
+
+    def test_changed_question_file(self):
+        s = self.start_server()
+        s.courseDB.add_student(1000, 'u0', 'User 0', 1000)
+        s.start_question(q='1')
+        self.submit(s, 1000, 'answer', answer='an answer', confidence='1')
+        self.crash(s)
+        ifile = open(self.questionFile, 'rb')
+        text = ifile.read()
+        ifile.close()
+        ofile = open(self.questionFile, 'wb') # edit a question
+        ofile.write(text.replace('?', '?!', 1))
+        ofile.close()
+        s2 = self.start_server() # must not replay against a changed file
+        self.assertFalse(s2.question.responses)
+        self.assertTrue(os.path.exists(self.dbfile + '.journal.old'))
+
+@unittest.skipIf(cherrypy is None, 'cherrypy not installed')
+class CourseMountTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.questionFile = os.path.join(self.tmpdir, 'questions.csv')
+        ofile = open(self.questionFile, 'wb')
+        ofile.write('image,A Sketch,Draw it.,Like this.,0,correct.png\n')
+        ofile.close()
+        router = coursedb.CourseRouter(self.tmpdir)
+        self.server = web.Server(self.questionFile, configPath=None,
+                                 journalFile=False, course='chem101',
+                                 router=router)
+        self.server2 = web.Server(self.questionFile, configPath=None,
+                                  journalFile=False, course='phys101',
+                                  router=router)
+
+    def tearDown(self):
+        self.server.courseDB.pool.close()
+        self.server2.courseDB.pool.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_static_urls(self):
+        'image and help links must be under the course mount point'
+        q = self.server.question
+        self.assertTrue('<IMG SRC="/chem101/images/correct.png">'
+                        in str(q.correctAnswer))
+        self.assertTrue('HREF="/chem101/images/help.html"' in str(q.doc))
+        self.assertTrue('src="/chem101/MathJax/MathJax.js'
+                        in q._viewHTML['answer'])
+        self.assertTrue('src="/chem101/MathJax/MathJax.js'
+                        in self.server._loginHTML)
+
+    def test_two_courses(self):
+        'each course must load MathJax from its own mount point'
+        html = self.server2.question._viewHTML['answer']
+        self.assertTrue('src="/phys101/MathJax/MathJax.js' in html)
+        self.assertFalse('chem101' in html)
+        for html in (self.server.question._viewHTML['answer'],
+                     self.server._admin_page(), # built after server2
+                     self.server.question.start_admin()):
+            self.assertTrue('src="/chem101/MathJax/MathJax.js' in html)
+            self.assertFalse('phys101' in html)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+'''measure per-object memory of Response and Student objects, with
+__slots__ (as in socraticqs) versus an equivalent __dict__-based
+object.  Usage: python tools/bench_memory.py'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'socraticqs'))
+import coursedb
+import question
+
+class DictObject(object):
+    'same attributes, stored in an ordinary instance __dict__'
+    pass
+
+def object_size(obj):
+    'sys.getsizeof() of obj plus its __dict__, if any'
+    size = sys.getsizeof(obj)
+    try:
+        size += sys.getsizeof(obj.__dict__)
+    except AttributeError:
+        pass
+    return size
+
+def as_dict_object(obj):
+    'copy of obj with every set slot stored in a __dict__ instead'
+    d = DictObject()
+    for klass in type(obj).__mro__:
+        for attr in getattr(klass, '__slots__', ()):
+            try:
+                setattr(d, attr, getattr(obj, attr))
+            except AttributeError: # slot not set
+                pass
+    return d
+
+class FakeQuestion(object):
+    choices = ('yes', 'no')
+    def changed(self):
+        pass
+
+def fill_stages(r):
+    'set every optional field that later stages would fill in'
+    r.id = 1
+    r.savedErrorIDs = [1]
+    r.prototype = r
+    r.response2 = r
+    r.confidence2 = 1
+    r.reasons = 'correct'
+    r.errorIDs = [1]
+    r.critiqueTarget = r
+    r.criticisms = 'none'
+    r.finalVote = r
+    r.finalConfidence = 2
+    return r
+
+def main():
+    q = FakeQuestion()
+    objects = (
+        ('TextResponse', fill_stages(question.TextResponse(1, q, 1,
+                                                           'an answer'))),
+        ('MultiChoiceResponse', fill_stages(
+            question.MultiChoiceResponse(1, q, 1, 0))),
+        ('Student', coursedb.Student(1, 'Jane Doe', 'jdoe')),
+        )
+    print '%-20s %8s %8s' % ('bytes per object', '__dict__', '__slots__')
+    for name, obj in objects:
+        print '%-20s %8d %8d' % (name, object_size(as_dict_object(obj)),
+                                 object_size(obj))
+
+if __name__ == '__main__':
+    main()